@@ -0,0 +1,40 @@
+import pytest
+from flask import Flask
+
+from flask_themer import Themer, FileSystemThemeLoader
+
+from conftest import make_themes
+
+
+@pytest.fixture(scope='module', params=[10, 1000, 10000])
+def themes_dir(request, tmp_path_factory):
+    return make_themes(
+        tmp_path_factory.mktemp('discovery') / 'themes',
+        request.param
+    )
+
+
+@pytest.mark.benchmark(group='init_app')
+def bench_flask(benchmark):
+    """Baseline: creating a plain Flask app."""
+    benchmark(Flask, 'benchmarks')
+
+
+@pytest.mark.benchmark(group='init_app')
+def bench_init_app(themes_dir, benchmark):
+    def init_app():
+        Themer(Flask('benchmarks'), loaders=[
+            FileSystemThemeLoader(themes_dir)
+        ])
+
+    benchmark(init_app)
+
+
+@pytest.mark.benchmark(group='init_app')
+def bench_init_app_lazy(themes_dir, benchmark):
+    def init_app():
+        Themer(Flask('benchmarks'), loaders=[
+            FileSystemThemeLoader(themes_dir, lazy=True)
+        ])
+
+    benchmark(init_app)
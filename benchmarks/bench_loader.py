@@ -0,0 +1,37 @@
+import pytest
+from jinja2 import FileSystemLoader, TemplateNotFound
+
+from flask_themer import MAGIC_PATH_PREFIX, _ThemeTemplateLoader
+
+
+@pytest.mark.benchmark(group='get_source')
+def bench_jinja_get_source(app, data_dir, benchmark):
+    """Baseline: loading a template with a plain Jinja FileSystemLoader."""
+    loader = FileSystemLoader(str(data_dir / 'themes' / 'default'))
+    benchmark(loader.get_source, app.jinja_env, 'page.html')
+
+
+@pytest.mark.benchmark(group='get_source')
+def bench_theme_get_source(app, benchmark):
+    loader = _ThemeTemplateLoader()
+    benchmark(
+        loader.get_source,
+        app.jinja_env,
+        f'{MAGIC_PATH_PREFIX}/default/page.html'
+    )
+
+
+@pytest.mark.benchmark(group='get_source')
+def bench_theme_get_source_miss(app, benchmark):
+    loader = _ThemeTemplateLoader()
+
+    def miss():
+        try:
+            loader.get_source(
+                app.jinja_env,
+                f'{MAGIC_PATH_PREFIX}/default/missing.html'
+            )
+        except TemplateNotFound:
+            pass
+
+    benchmark(miss)
@@ -0,0 +1,26 @@
+import pytest
+from flask import url_for
+
+from flask_themer import lookup_theme_path, lookup_static_theme_path
+
+
+@pytest.mark.benchmark(group='lookup_theme_path')
+def bench_lookup_theme_path(app, benchmark):
+    benchmark(lookup_theme_path, 'page.html')
+
+
+@pytest.mark.benchmark(group='lookup_static_theme_path')
+def bench_flask_url_for_static(app, benchmark):
+    """Baseline: building a URL to one of the app's own static files."""
+    benchmark(url_for, 'static', filename='site.css')
+
+
+@pytest.mark.benchmark(group='lookup_static_theme_path')
+def bench_lookup_static_theme_path(app, benchmark):
+    benchmark(lookup_static_theme_path, 'site.css')
+
+
+@pytest.mark.benchmark(group='lookup_static_theme_path')
+def bench_lookup_static_theme_path_fingerprinted(app, benchmark):
+    app.config['THEMER_STATIC_FINGERPRINT'] = True
+    benchmark(lookup_static_theme_path, 'site.css')
@@ -0,0 +1,22 @@
+import pytest
+from flask import render_template as flask_render_template
+
+from flask_themer import render_template
+
+
+@pytest.mark.benchmark(group='render_template')
+def bench_flask_render_template(app, benchmark):
+    """Baseline: rendering a template with plain Flask."""
+    benchmark(flask_render_template, 'fallback.html', name='world')
+
+
+@pytest.mark.benchmark(group='render_template')
+def bench_themed_hit(app, benchmark):
+    """Rendering a template provided by the active theme."""
+    benchmark(render_template, 'page.html', name='world')
+
+
+@pytest.mark.benchmark(group='render_template')
+def bench_themed_fallback(app, benchmark):
+    """Rendering a template the active theme doesn't provide."""
+    benchmark(render_template, 'fallback.html', name='world')
@@ -0,0 +1,42 @@
+import pytest
+
+from conftest import make_app
+
+
+@pytest.fixture
+def client(app):
+    with app.test_client() as client:
+        yield client
+
+
+@pytest.fixture
+def cached_client(data_dir):
+    app = make_app(data_dir, THEMER_STATIC_CACHE_SIZE=1024 * 1024)
+    with app.test_client() as client:
+        yield client
+
+
+@pytest.mark.benchmark(group='serve_static')
+def bench_flask_static(client, benchmark):
+    """Baseline: serving one of the app's own static files."""
+    benchmark(client.get, 'http://benchmarks/static/site.css')
+
+
+@pytest.mark.benchmark(group='serve_static')
+def bench_serve_static(client, benchmark):
+    benchmark(client.get, 'http://benchmarks/_theme/default/site.css')
+
+
+@pytest.mark.benchmark(group='serve_static')
+def bench_serve_static_cached(cached_client, benchmark):
+    benchmark(cached_client.get, 'http://benchmarks/_theme/default/site.css')
+
+
+@pytest.mark.benchmark(group='serve_static')
+def bench_serve_static_not_modified(client, benchmark):
+    etag = client.get('http://benchmarks/_theme/default/site.css').get_etag()
+    benchmark(
+        client.get,
+        'http://benchmarks/_theme/default/site.css',
+        headers={'If-None-Match': f'"{etag[0]}"'}
+    )
@@ -0,0 +1,70 @@
+from pathlib import Path
+
+import pytest
+from flask import Flask
+
+from flask_themer import Themer, FileSystemThemeLoader
+
+
+@pytest.fixture(scope='session')
+def data_dir(tmp_path_factory):
+    """A directory of themes, plus the app's own templates and static
+    files."""
+    root = tmp_path_factory.mktemp('benchmarks')
+
+    theme = root / 'themes' / 'default'
+    (theme / 'static').mkdir(parents=True)
+    (theme / 'page.html').write_text(
+        '{% extends theme("layout.html") %}'
+        '{% block body %}<p>Hello {{ name }}!</p>{% endblock %}'
+    )
+    (theme / 'layout.html').write_text(
+        '<html><head>'
+        '<link rel="stylesheet" href="{{ theme_static("site.css") }}">'
+        '</head><body>{% block body %}{% endblock %}</body></html>'
+    )
+    (theme / 'static' / 'site.css').write_text('body { color: red; }\n' * 200)
+
+    (root / 'templates').mkdir()
+    (root / 'templates' / 'fallback.html').write_text(
+        '<html><body><p>Hello {{ name }}!</p></body></html>'
+    )
+    (root / 'static').mkdir()
+    (root / 'static' / 'site.css').write_text('body { color: red; }\n' * 200)
+
+    return root
+
+
+def make_app(data_dir: Path, **config) -> Flask:
+    """Create an app using the themes in `data_dir`, with the active theme
+    always being `default`."""
+    app = Flask(
+        'benchmarks',
+        root_path=str(data_dir),
+        template_folder=str(data_dir / 'templates'),
+        static_folder=str(data_dir / 'static')
+    )
+    app.config['SERVER_NAME'] = 'benchmarks'
+    app.config.update(config)
+
+    themer = Themer(app, loaders=[
+        FileSystemThemeLoader(data_dir / 'themes')
+    ])
+    themer.current_theme_loader(lambda: 'default')
+    return app
+
+
+@pytest.fixture
+def app(data_dir):
+    app = make_app(data_dir)
+    with app.test_request_context():
+        yield app
+
+
+def make_themes(path: Path, count: int) -> Path:
+    """Create `count` themes, each with a single template, under `path`."""
+    path.mkdir()
+    for i in range(count):
+        (path / f'theme_{i}').mkdir()
+        (path / f'theme_{i}' / 'page.html').write_text('Page')
+    return path
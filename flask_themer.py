@@ -1,12 +1,61 @@
+import io
+import os
+import gzip
+import queue
+import asyncio
+import inspect
+import functools
+import mmap
+import zlib
+import struct
+import shutil
+import zipfile
+import tempfile
+import stat
+import hashlib
+import mimetypes
+import threading
+import time
+import weakref
 from pathlib import Path
+import dataclasses
 from dataclasses import dataclass, field
-from typing import Iterable, Callable, Optional, Union
+from typing import (
+    Any, Iterable, Callable, Optional, Union, Dict, NamedTuple, Tuple, List
+)
 from contextlib import contextmanager
+from urllib.parse import quote
+from contextvars import ContextVar, copy_context
+from collections import OrderedDict
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+)
 
+import click
 from flask import render_template as flask_render_template
+from flask import stream_template as flask_stream_template
 from flask import current_app, Blueprint, url_for, send_from_directory, abort
-from jinja2 import TemplateNotFound
-from jinja2.loaders import BaseLoader, FileSystemLoader
+from flask import g, has_app_context, has_request_context, request
+from flask import make_response, before_render_template, template_rendered
+from flask.cli import AppGroup
+from jinja2 import TemplateNotFound, TemplateSyntaxError
+from jinja2.bccache import BytecodeCache, Bucket
+from jinja2.loaders import (
+    BaseLoader, FileSystemLoader, ModuleLoader, split_template_path
+)
+from werkzeug.exceptions import HTTPException
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+
+try:
+    import brotli  # type: ignore
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    from watchdog.observers import Observer  # type: ignore
+except ImportError:  # pragma: no cover
+    Observer = None  # type: ignore
 
 
 #: The key under which the extension instance will be saved under the flask
@@ -18,6 +67,45 @@ CONFIG_PREFIX = 'THEMER_'
 #: The presence of this value is what's used to decide if theming should handle
 #: a template lookup. By default, it's a unicode snowman.
 MAGIC_PATH_PREFIX = '\u2603'
+#: The attribute on `flask.g` used to remember the resolved theme for the
+#: lifetime of the current app context.
+_CURRENT_THEME_ATTR = '_themer_current_theme'
+#: The query argument used to add a fingerprint to static URLs.
+FINGERPRINT_ARG = 'v'
+#: The number of characters of a static asset's digest used as its
+#: fingerprint.
+FINGERPRINT_LENGTH = 12
+#: How long, in seconds, clients are told to cache fingerprinted static
+#: assets.
+FINGERPRINT_MAX_AGE = 365 * 24 * 60 * 60
+#: Content encodings and the file suffixes used for precompressed copies of
+#: static assets, in order of preference.
+PRECOMPRESSED_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+#: The upper bounds, in seconds, of the buckets used by latency histograms.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+#: Descriptions of the metrics recorded by `Themer`, used as the help text
+#: when exporting them.
+METRIC_DESCRIPTIONS = {
+    'themer_render_total':
+        'Templates rendered by render_template, by theme and result.',
+    'themer_template_misses_total':
+        'Themed templates that could not be loaded, by reason.',
+    'themer_resolver_calls_total':
+        'Calls to the current theme resolver.',
+    'themer_resolver_seconds':
+        'Time spent in the current theme resolver.',
+    'themer_static_responses_total':
+        'Static asset responses, by theme and status code.',
+    'themer_static_bytes_total':
+        'Bytes of static asset responses, by theme.',
+    'themer_static_seconds':
+        'Time spent serving static assets, by theme.',
+    'themer_static_cache_requests_total':
+        'Static asset cache lookups, by result.',
+}
 
 
 class ThemeError(Exception):
@@ -47,6 +135,11 @@ class Theme:
 
 
 class ThemeLoader:
+    #: If True, the loader's themes aren't discovered by `Themer.init_app`,
+    #: and are instead looked up one at a time using `get_theme()` the first
+    #: time they're used.
+    lazy = False
+
     @property
     def themes(self) -> Iterable[Theme]:
         """
@@ -54,77 +147,1783 @@ class ThemeLoader:
         """
         raise NotImplementedError
 
-    def get_static(self, theme: str, path: str) -> bytes:
+    def get_theme(self, name: str) -> Optional[Theme]:
+        """
+        Return the theme called `name`, or `None` if this loader doesn't
+        provide it.
+
+        Loaders that support being `lazy` should override this with something
+        cheaper than searching through every theme.
+        """
+        for theme in self.themes:
+            if theme.name == name:
+                return theme
+        return None
+
+    def get_static(self, theme: str, path: str) -> bytes:
+        """
+        Return a static asset for the given theme and path.
+        """
+        raise NotImplementedError
+
+    def get_static_digest(self, theme: str, path: str) -> Optional[str]:
+        """
+        Return a hash of the contents of the static asset for the given theme
+        and path, or `None` if it isn't known.
+
+        This should be cheap to call repeatedly, so implementations should
+        cache it. It's used to fingerprint static URLs.
+        """
+        return None
+
+    def invalidate(self, theme: Optional[str] = None):
+        """
+        Forget anything cached by the loader for `theme`, or for every theme
+        if no theme is given. Called by `Themer.invalidate`.
+        """
+
+
+class IndexedFile(NamedTuple):
+    #: The full path to the file on disk.
+    path: str
+    #: The modification time of the file when it was indexed.
+    mtime: float
+    #: The size of the file in bytes when it was indexed.
+    size: int
+
+
+class IndexedFileSystemLoader(BaseLoader):
+    """A Jinja2 template loader similar to `FileSystemLoader`, but which walks
+    `path` once on first use and keeps an in-memory index of every file in it.
+
+    Checking for a template that doesn't exist is then a dictionary lookup
+    rather than a trip to the filesystem. The index is a snapshot, so call
+    `reindex()` after adding or removing files.
+    """
+    def __init__(self, path: Union[Path, str], encoding: str = 'utf-8'):
+        self.path = str(path)
+        self.encoding = encoding
+        self._index: Optional[Dict[str, IndexedFile]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def index(self) -> Dict[str, IndexedFile]:
+        """A dict mapping template names to `IndexedFile` entries, built the
+        first time it's accessed."""
+        index = self._index
+        if index is None:
+            with self._lock:
+                index = self._index
+                if index is None:
+                    index = self._index = self._build_index()
+        return index
+
+    def _build_index(self) -> Dict[str, IndexedFile]:
+        index = {}
+        # Symlinked directories are followed, just like FileSystemLoader
+        # does when opening templates, but a link back to one of its own
+        # parents is skipped so we don't recurse forever. Maps directories
+        # still to be walked to the (device, inode) of their parents.
+        parents: Dict[str, frozenset] = {self.path: frozenset()}
+        for root, dirs, files in os.walk(self.path, followlinks=True):
+            try:
+                st = os.stat(root)
+            except OSError:
+                dirs[:] = []
+                continue
+
+            chain = parents.pop(root, frozenset())
+            if (st.st_dev, st.st_ino) in chain:
+                dirs[:] = []
+                continue
+
+            chain = chain | {(st.st_dev, st.st_ino)}
+            for d in dirs:
+                parents[os.path.join(root, d)] = chain
+
+            for filename in files:
+                full_path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(full_path)
+                except OSError:
+                    # Removed while we were walking, or a broken link.
+                    continue
+                name = os.path.relpath(full_path, self.path)
+                index[name.replace(os.sep, '/')] = IndexedFile(
+                    path=full_path,
+                    mtime=stat.st_mtime,
+                    size=stat.st_size
+                )
+        return index
+
+    def reindex(self):
+        """Discard the current index, rebuilding it on next use."""
+        self._index = None
+
+    def __contains__(self, template: str) -> bool:
+        try:
+            return '/'.join(split_template_path(template)) in self.index
+        except TemplateNotFound:
+            return False
+
+    def get_source(self, environment, template):
+        try:
+            entry = self.index['/'.join(split_template_path(template))]
+        except KeyError:
+            raise TemplateNotFound(template)
+
+        try:
+            mtime = os.path.getmtime(entry.path)
+            with open(entry.path, encoding=self.encoding) as fin:
+                contents = fin.read()
+        except FileNotFoundError:
+            raise TemplateNotFound(template)
+
+        # Compare against the file as it was read, not as it was indexed, or
+        # a template changed since indexing would never be up to date.
+        def uptodate():
+            try:
+                return os.path.getmtime(entry.path) == mtime
+            except OSError:
+                return False
+
+        return contents, entry.path, uptodate
+
+    def list_templates(self):
+        return sorted(self.index)
+
+
+class FileSystemThemeLoader(ThemeLoader):
+    """A simple theme loader that assumes all sub-directories immediately under
+    `path` are themes.
+
+    If `index` is True, each theme's files are indexed in memory on first use
+    using an `IndexedFileSystemLoader`, avoiding filesystem access when
+    looking up templates that don't exist. Call `Themer.invalidate()` after
+    adding or removing files.
+
+    If `precompressed` is True, static assets are served from `.br` or `.gz`
+    files next to them when they exist and the client accepts that encoding.
+    These can be created with `flask themer compress`.
+
+    If `lazy` is True, themes aren't discovered up front, and are instead
+    found the first time they're used. This is much faster to start for
+    very large numbers of themes.
+
+    `parents` can map theme names to the name of the theme they inherit
+    from.
+    """
+    def __init__(self, path: Union[Path, str],
+                 filter: Optional[Callable[[Path], bool]] = None,
+                 index: bool = False,
+                 precompressed: bool = False,
+                 lazy: bool = False,
+                 parents: Optional[Dict[str, str]] = None):
+        #: The path the loader is searching for themes.
+        self.path = Path(path)
+        self.lazy = lazy
+        self._filter = filter
+        self._parents = parents or {}
+        self._index = index
+        self._precompressed = precompressed
+        #: Maps the paths of static assets to their (mtime, size, digest).
+        self._digests: Dict[str, Tuple[int, int, str]] = {}
+        #: The index of each theme still in use, when `index` is True.
+        self._indexes: weakref.WeakValueDictionary[
+            str, IndexedFileSystemLoader
+        ] = weakref.WeakValueDictionary()
+        self._indexes_lock = threading.Lock()
+
+    @property
+    def themes(self):
+        themes = {}
+        if self.path.exists():
+            for child in self.path.iterdir():
+                if not child.is_dir():
+                    continue
+
+                if self._filter and not self._filter(child):
+                    continue
+
+                yield self._make_theme(child)
+
+        return themes
+
+    def get_theme(self, name):
+        # Names come straight from URLs and templates, so make sure they
+        # can't be used to reach outside of our path.
+        if not name or name in ('.', '..') or '/' in name or os.sep in name:
+            return None
+
+        child = self.path / name
+        if not child.is_dir():
+            return None
+
+        if self._filter and not self._filter(child):
+            return None
+
+        return self._make_theme(child)
+
+    def _make_theme(self, path: Path) -> Theme:
+        return Theme(
+            jinja_loader=(
+                self._get_index(path) if self._index
+                else FileSystemLoader(str(path))
+            ),
+            theme_loader=self,
+            name=path.name,
+            data=(
+                {'parent': self._parents[path.name]}
+                if path.name in self._parents else {}
+            )
+        )
+
+    def _get_index(self, path: Path) -> IndexedFileSystemLoader:
+        """Returns the index for the theme at `path`, shared by every `Theme`
+        made for it so `invalidate()` can find it."""
+        with self._indexes_lock:
+            index = self._indexes.get(path.name)
+            if index is None:
+                index = self._indexes[path.name] = IndexedFileSystemLoader(
+                    path
+                )
+            return index
+
+    def invalidate(self, theme: Optional[str] = None):
+        with self._indexes_lock:
+            indexes = [
+                index for name, index in list(self._indexes.items())
+                if theme is None or name == theme
+            ]
+
+        for index in indexes:
+            index.reindex()
+
+    def get_static(self, theme, path):
+        directory = self.path / theme / 'static'
+        if not self._precompressed:
+            return send_from_directory(directory, path)
+
+        source = safe_join(str(directory), path)
+        try:
+            source_mtime = os.stat(source).st_mtime_ns if source else None
+        except OSError:
+            source_mtime = None
+
+        for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+            if source_mtime is None:
+                continue
+
+            if not request.accept_encodings.quality(encoding):
+                continue
+
+            sidecar = safe_join(str(directory), path + suffix)
+            if sidecar is None or not os.path.isfile(sidecar):
+                continue
+
+            # A copy older than the asset is out of date, and sending it
+            # would serve the old contents under the new fingerprint.
+            if os.stat(sidecar).st_mtime_ns < source_mtime:
+                continue
+
+            response = send_from_directory(
+                directory,
+                path + suffix,
+                mimetype=(
+                    mimetypes.guess_type(path)[0] or
+                    'application/octet-stream'
+                )
+            )
+            response.content_encoding = encoding
+            break
+        else:
+            response = send_from_directory(directory, path)
+
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def iter_static_files(self, theme: str) -> Iterable[str]:
+        """Yield the path to every static asset in `theme`, excluding any
+        precompressed copies."""
+        suffixes = tuple(suffix for _, suffix in PRECOMPRESSED_ENCODINGS)
+        for root, _, files in os.walk(self.path / theme / 'static'):
+            for filename in files:
+                if not filename.endswith(suffixes):
+                    yield os.path.join(root, filename)
+
+    def get_static_digest(self, theme, path):
+        full_path = safe_join(str(self.path), theme, 'static', path)
+        if full_path is None:
+            return None
+
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            return None
+
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        cached = self._digests.get(full_path)
+        if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+
+        digest = hashlib.sha256()
+        with open(full_path, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(65536), b''):
+                digest.update(chunk)
+
+        result = digest.hexdigest()
+        self._digests[full_path] = (st.st_mtime_ns, st.st_size, result)
+        return result
+
+
+class _ArchiveMember(NamedTuple):
+    #: The offset of the member's data from the start of the archive.
+    offset: int
+    #: The zipfile compression method used for the member.
+    compress_type: int
+    #: The size of the member's data within the archive.
+    compress_size: int
+    #: The full name of the member within the archive.
+    filename: str
+
+
+class _MemoryFile(io.RawIOBase):
+    """A read-only file over a buffer, so it can be sent with the WSGI
+    server's `wsgi.file_wrapper` without copying all of it at once."""
+    def __init__(self, buffer: Union[bytes, memoryview]):
+        self._view = memoryview(buffer)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        chunk = self._view[self._position:self._position + len(b)]
+        b[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+
+class ArchiveTemplateLoader(BaseLoader):
+    """A Jinja2 template loader that loads templates for a single theme from
+    an `ArchiveThemeLoader`."""
+    def __init__(self, archive: 'ArchiveThemeLoader', theme: str,
+                 encoding: str = 'utf-8'):
+        self.archive = archive
+        self.theme = theme
+        self.encoding = encoding
+
+    def get_source(self, environment, template):
+        member = self.archive._get_member(self.theme, template)
+        if member is None:
+            raise TemplateNotFound(template)
+
+        contents = bytes(self.archive._read(member)).decode(self.encoding)
+        # Archives are never modified once opened, so templates are always
+        # up to date.
+        return contents, f'{self.archive.path}/{member.filename}', None
+
+    def list_templates(self):
+        return sorted(self.archive._members.get(self.theme, ()))
+
+
+class ArchiveThemeLoader(ThemeLoader):
+    """A theme loader that assumes all directories at the top of the ZIP
+    archive at `path` are themes.
+
+    The archive is memory-mapped and indexed once when the loader is created,
+    after which it's safe to read from any number of threads at once.
+    Static assets that are stored uncompressed are served directly from the
+    memory-mapped archive without being copied.
+
+    The archive is treated as immutable. To deploy a new version of it,
+    replace the file and restart the app.
+    """
+    def __init__(self, path: Union[Path, str],
+                 filter: Optional[Callable[[str], bool]] = None):
+        #: The path to the archive.
+        self.path = Path(path)
+        self._filter = filter
+        #: Maps theme names to a dict of the paths within that theme to
+        #: their `_ArchiveMember`.
+        self._members: Dict[str, Dict[str, _ArchiveMember]] = {}
+        #: Maps (theme, path) to the digests of static assets.
+        self._digests: Dict[Tuple[str, str], str] = {}
+
+        with zipfile.ZipFile(self.path) as archive:
+            infos = archive.infolist()
+
+        with open(self.path, 'rb') as fin:
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        for info in infos:
+            theme, _, name = info.filename.partition('/')
+            # Skip directories, anything outside of a theme and encrypted
+            # members.
+            if not name or info.is_dir() or info.flag_bits & 0x1:
+                continue
+
+            # The central directory doesn't tell us where the data actually
+            # starts, we need to skip over the local file header.
+            name_length, extra_length = struct.unpack_from(
+                '<HH',
+                self._mmap,
+                info.header_offset + 26
+            )
+
+            self._members.setdefault(theme, {})[name] = _ArchiveMember(
+                offset=info.header_offset + 30 + name_length + extra_length,
+                compress_type=info.compress_type,
+                compress_size=info.compress_size,
+                filename=info.filename
+            )
+
+    @property
+    def themes(self):
+        for name in self._members:
+            if self._filter and not self._filter(name):
+                continue
+
+            yield Theme(
+                jinja_loader=ArchiveTemplateLoader(self, name),
+                theme_loader=self,
+                name=name
+            )
+
+    def _get_member(self, theme: str, path: str) -> Optional[_ArchiveMember]:
+        try:
+            path = '/'.join(split_template_path(path))
+        except TemplateNotFound:
+            return None
+        return self._members.get(theme, {}).get(path)
+
+    def _read(self, member: _ArchiveMember) -> Union[bytes, memoryview]:
+        """Returns the uncompressed contents of `member`."""
+        if member.compress_type == zipfile.ZIP_STORED:
+            return memoryview(self._mmap)[
+                member.offset:member.offset + member.compress_size
+            ]
+        elif member.compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(
+                self._mmap[member.offset:member.offset + member.compress_size],
+                -zlib.MAX_WBITS
+            )
+
+        # Anything else is rare enough to not be worth handling ourselves. A
+        # new ZipFile is used each time, since they can't be shared between
+        # threads.
+        with zipfile.ZipFile(self.path) as archive:
+            return archive.read(member.filename)
+
+    def get_static(self, theme, path):
+        member = self._get_member(theme, f'static/{path}')
+        if member is None:
+            abort(404)
+
+        data = self._read(member)
+        # WSGI servers only accept bytes, so stored members are read from
+        # the mapped archive a chunk at a time rather than sent as is.
+        response = current_app.response_class(
+            wrap_file(request.environ, _MemoryFile(data)),
+            mimetype=(
+                mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            ),
+            direct_passthrough=True
+        )
+        response.content_length = len(data)
+        return response
+
+    def get_static_digest(self, theme, path):
+        try:
+            return self._digests[(theme, path)]
+        except KeyError:
+            pass
+
+        member = self._get_member(theme, f'static/{path}')
+        if member is None:
+            return None
+
+        digest = hashlib.sha256(self._read(member)).hexdigest()
+        self._digests[(theme, path)] = digest
+        return digest
+
+
+class ConnectionPool:
+    """A thread-safe pool of DB-API connections.
+
+    Connections are opened on demand by calling `connect`, and up to `size`
+    of them are kept open and reused. Once that many are in use, callers
+    wait for one to be returned.
+    """
+    def __init__(self, connect: Callable[[], Any], size: int = 4):
+        self._connect = connect
+        #: The maximum number of connections open at once.
+        self.size = size
+        # Idle connections, on top of a placeholder for each connection that
+        # hasn't been opened yet, so open connections are reused first.
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(None)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection from the pool for the duration of the
+        `with` block."""
+        connection = self._idle.get()
+        if connection is None:
+            try:
+                connection = self._connect()
+            except BaseException:
+                self._idle.put(None)
+                raise
+
+        try:
+            yield connection
+            # Don't leave a transaction open while the connection sits idle.
+            connection.rollback()
+        except BaseException:
+            # The connection may be in a bad state, so close it and let the
+            # next caller open a fresh one.
+            self._idle.put(None)
+            try:
+                connection.close()
+            except Exception:
+                pass
+            raise
+
+        self._idle.put(connection)
+
+    def close(self):
+        """Close every idle connection."""
+        closed = []
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+
+            if connection is not None:
+                connection.close()
+            closed.append(None)
+
+        for placeholder in closed:
+            self._idle.put(placeholder)
+
+
+class _SQLFile(NamedTuple):
+    #: The contents of the file.
+    content: bytes
+    #: The version of the file when it was loaded.
+    version: Any
+
+
+class SQLTemplateLoader(BaseLoader):
+    """A Jinja2 template loader that loads templates for a single theme from
+    a `SQLThemeLoader`."""
+    def __init__(self, sql: 'SQLThemeLoader', theme: str,
+                 encoding: str = 'utf-8'):
+        self.sql = sql
+        self.theme = theme
+        self.encoding = encoding
+
+    def get_source(self, environment, template):
+        path = '/'.join(split_template_path(template))
+        file = self.sql._files(self.theme).get(path)
+        if file is None:
+            raise TemplateNotFound(template)
+
+        def uptodate():
+            if self.sql._version(self.theme, path) == file.version:
+                return True
+            # Load the theme again the next time one of its files is used.
+            self.sql.invalidate(self.theme)
+            return False
+
+        return file.content.decode(self.encoding), None, uptodate
+
+    def list_templates(self):
+        return sorted(self.sql._files(self.theme))
+
+
+class SQLThemeLoader(ThemeLoader):
+    """A theme loader that loads themes from a table in a SQL database, with
+    a row for each file in a theme:
+
+        .. code-block:: sql
+
+            CREATE TABLE theme_files (
+                theme TEXT NOT NULL,
+                path TEXT NOT NULL,
+                content BLOB NOT NULL,
+                version INTEGER NOT NULL,
+                PRIMARY KEY (theme, path)
+            );
+
+    Static assets are the files whose path starts with `static/`. `version`
+    can be anything that changes whenever `content` does, such as a counter
+    or an updated-at timestamp.
+
+    `connect` is called to open a new DB-API connection, and up to
+    `pool_size` of them are kept open in a `ConnectionPool`. `placeholder` is
+    the parameter marker used by the database driver, such as `?` for
+    sqlite3 or `%s` for psycopg.
+
+    The first time a theme is used, all of its files are loaded with a
+    single query and kept in memory, for up to `cache_size` of the most
+    recently used themes. When Jinja's `auto_reload` is enabled, each
+    template checks its `version` before being reused, and the theme is
+    loaded again if it changed. Otherwise, call `invalidate()` or
+    `Themer.invalidate()` after changing a theme.
+
+    `lazy` and `parents` work the same way as they do for
+    `FileSystemThemeLoader`.
+    """
+    def __init__(self, connect: Callable[[], Any], *,
+                 table: str = 'theme_files',
+                 placeholder: str = '?',
+                 pool_size: int = 4,
+                 cache_size: int = 128,
+                 lazy: bool = False,
+                 parents: Optional[Dict[str, str]] = None):
+        #: The pool of connections used to query the database.
+        self.pool = ConnectionPool(connect, size=pool_size)
+        #: The name of the table themes are loaded from.
+        self.table = table
+        self.lazy = lazy
+        self._placeholder = placeholder
+        self._parents = parents or {}
+        #: Maps theme names to a dict of their files, least recently used
+        #: first.
+        self._cache: OrderedDict[str, Dict[str, _SQLFile]] = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        #: Maps (theme, path) to the digests of static assets.
+        self._digests: Dict[Tuple[str, str], str] = {}
+
+    def _query(self, sql: str, *params) -> list:
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(
+                    sql.format(table=self.table, p=self._placeholder),
+                    params
+                )
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    @property
+    def themes(self):
+        for (name,) in self._query(
+                'SELECT DISTINCT theme FROM {table} ORDER BY theme'):
+            yield self._make_theme(name)
+
+    def get_theme(self, name):
+        if self._query(
+                'SELECT 1 FROM {table} WHERE theme = {p} LIMIT 1', name):
+            return self._make_theme(name)
+        return None
+
+    def _make_theme(self, name: str) -> Theme:
+        return Theme(
+            jinja_loader=SQLTemplateLoader(self, name),
+            theme_loader=self,
+            name=name,
+            data={'parent': self._parents[name]} if name in self._parents
+            else {}
+        )
+
+    def _files(self, theme: str) -> Dict[str, _SQLFile]:
+        """Returns every file in `theme`, loading them all if they aren't
+        already cached."""
+        with self._cache_lock:
+            files = self._cache.get(theme)
+            if files is not None:
+                self._cache.move_to_end(theme)
+                return files
+
+        files = {
+            path: _SQLFile(
+                # Drivers return BLOBs as bytes, memoryview or str.
+                content=(
+                    content.encode('utf-8') if isinstance(content, str)
+                    else bytes(content)
+                ),
+                version=version
+            )
+            for path, content, version in self._query(
+                'SELECT path, content, version FROM {table} '
+                'WHERE theme = {p}',
+                theme
+            )
+        }
+
+        with self._cache_lock:
+            self._cache[theme] = files
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+        return files
+
+    def _version(self, theme: str, path: str):
+        """Returns the current version of a file, or `None` if it no longer
+        exists."""
+        rows = self._query(
+            'SELECT version FROM {table} WHERE theme = {p} AND path = {p}',
+            theme,
+            path
+        )
+        return rows[0][0] if rows else None
+
+    def invalidate(self, theme: Optional[str] = None):
+        """Forget the cached files of `theme`, or of every theme if no theme
+        is given, so they're loaded again the next time they're used."""
+        with self._cache_lock:
+            if theme is None:
+                self._cache.clear()
+                self._digests.clear()
+                return
+
+            self._cache.pop(theme, None)
+            for key in [k for k in list(self._digests) if k[0] == theme]:
+                self._digests.pop(key, None)
+
+    def _get_static_file(self, theme: str, path: str) -> Optional[_SQLFile]:
+        try:
+            path = '/'.join(split_template_path(path))
+        except TemplateNotFound:
+            return None
+        return self._files(theme).get(f'static/{path}')
+
+    def get_static(self, theme, path):
+        file = self._get_static_file(theme, path)
+        if file is None:
+            abort(404)
+
+        return current_app.response_class(
+            file.content,
+            mimetype=(
+                mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            )
+        )
+
+    def get_static_digest(self, theme, path):
+        try:
+            return self._digests[(theme, path)]
+        except KeyError:
+            pass
+
+        file = self._get_static_file(theme, path)
+        if file is None:
+            return None
+
+        digest = hashlib.sha256(file.content).hexdigest()
+        self._digests[(theme, path)] = digest
+        return digest
+
+
+class CachedStatic(NamedTuple):
+    #: The body of the response.
+    body: bytes
+    #: The status code of the response.
+    status: int
+    #: The headers of the response.
+    headers: List[Tuple[str, str]]
+    #: The digest of the asset, as returned by `ThemeLoader.get_static_digest`.
+    digest: Optional[str]
+
+
+class StaticCache:
+    """A thread-safe, in-memory LRU cache of static asset responses, bounded
+    by the total size of the cached bodies.
+
+    Entries are kept until they're evicted to make room for others or
+    explicitly removed with `evict()`.
+    """
+    def __init__(self, max_size: int, max_file_size: int):
+        #: The maximum total size of all cached bodies, in bytes.
+        self.max_size = max_size
+        #: The maximum size of a single cached body, in bytes.
+        self.max_file_size = max_file_size
+        #: The current total size of all cached bodies, in bytes.
+        self.size = 0
+        #: The number of lookups that found an entry.
+        self.hits = 0
+        #: The number of lookups that didn't find an entry.
+        self.misses = 0
+        self._entries: OrderedDict[tuple, CachedStatic] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: tuple) -> Optional[CachedStatic]:
+        """Return the entry for `key`, or `None` if it isn't cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def store(self, key: tuple, response, digest: Optional[str]) -> bool:
+        """Cache `response` under `key` if it's a successful response small
+        enough to fit. Returns True if it was cached.
+
+        `key` must start with the name of the theme the asset belongs to.
+        """
+        if response.status_code != 200 or 'X-Sendfile' in response.headers:
+            return False
+
+        length = response.content_length
+        if length is None or length > min(self.max_file_size, self.max_size):
+            return False
+
+        # Read the body so it can be cached, which also turns a streamed
+        # file response into a plain one.
+        response.direct_passthrough = False
+        entry = CachedStatic(
+            body=response.get_data(),
+            status=response.status_code,
+            headers=list(response.headers.items()),
+            digest=digest
+        )
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.body)
+
+            while self._entries and \
+                    self.size + len(entry.body) > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.body)
+
+            self._entries[key] = entry
+            self.size += len(entry.body)
+
+        return True
+
+    def evict(self, theme: Optional[str] = None):
+        """Remove every entry for `theme`, or every entry if no theme is
+        given."""
+        with self._lock:
+            if theme is None:
+                self._entries.clear()
+                self.size = 0
+                return
+
+            for key in [k for k in self._entries if k[0] == theme]:
+                self.size -= len(self._entries.pop(key).body)
+
+
+@dataclass
+class TemplateCacheStats:
+    #: The number of lookups that found a template.
+    hits: int = 0
+    #: The number of lookups that didn't find a template.
+    misses: int = 0
+    #: The number of templates dropped to make room for others.
+    evictions: int = 0
+    #: The number of templates currently cached.
+    templates: int = 0
+    #: The total weight of the templates currently cached.
+    size: int = 0
+
+
+class ThemedTemplateCache:
+    """A thread-safe replacement for Jinja's template cache that gives each
+    theme its own share of the cache.
+
+    Templates are weighted by the size of their compiled code. No theme can
+    use more than `theme_quota` of the total `max_size`, and when the cache
+    is full, templates are dropped from the least recently used theme first,
+    so busy themes stay cached while rarely used ones make way. The app's
+    own templates are treated as a theme called `None`.
+    """
+    def __init__(self, max_size: int, theme_quota: Optional[int] = None):
+        #: The maximum total weight of all cached templates.
+        self.max_size = max_size
+        #: The maximum total weight of the templates cached for one theme.
+        self.theme_quota = theme_quota or max_size
+        #: The current total weight of all cached templates.
+        self.size = 0
+        #: Maps theme names to the cached (template, weight) for each key,
+        #: least recently used theme and template first.
+        self._themes: OrderedDict[Optional[str], OrderedDict] = OrderedDict()
+        #: Usage statistics for each theme in `_themes`, dropped along with
+        #: its last template so they can't grow without limit.
+        self._stats: Dict[Optional[str], TemplateCacheStats] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self) -> int:
+        """The same as `max_size`, for code expecting Jinja's `LRUCache`,
+        such as `Environment.overlay()`."""
+        return self.max_size
+
+    def copy(self) -> 'ThemedTemplateCache':
+        """Returns an empty cache with the same limits."""
+        return ThemedTemplateCache(self.max_size, self.theme_quota)
+
+    @staticmethod
+    def _theme_of(key) -> Optional[str]:
+        name = key[1]
+        if not name.startswith(MAGIC_PATH_PREFIX):
+            return None
+        return name[len(MAGIC_PATH_PREFIX) + 1:].partition('/')[0]
+
+    @staticmethod
+    def _weight(template) -> int:
+        """Returns the size of the bytecode compiled for `template`."""
+        weight = 0
+        functions = [template.root_render_func, *template.blocks.values()]
+        pending = [f.__code__ for f in functions if hasattr(f, '__code__')]
+        while pending:
+            code = pending.pop()
+            weight += len(code.co_code)
+            pending.extend(
+                const for const in code.co_consts
+                if inspect.iscode(const)
+            )
+        return max(weight, 1)
+
+    def _get_stats(self, theme: Optional[str]) -> TemplateCacheStats:
+        stats = self._stats.get(theme)
+        if stats is None:
+            stats = self._stats[theme] = TemplateCacheStats()
+        return stats
+
+    def get(self, key, default=None):
+        theme = self._theme_of(key)
+        with self._lock:
+            entries = self._themes.get(theme)
+            if entries is None:
+                # Nothing is tracked for themes without cached templates.
+                return default
+
+            stats = self._stats[theme]
+            if key not in entries:
+                stats.misses += 1
+                return default
+
+            entries.move_to_end(key)
+            self._themes.move_to_end(theme)
+            stats.hits += 1
+            return entries[key][0]
+
+    def __getitem__(self, key):
+        template = self.get(key)
+        if template is None:
+            raise KeyError(key)
+        return template
+
+    def __setitem__(self, key, template):
+        theme = self._theme_of(key)
+        weight = self._weight(template)
+
+        with self._lock:
+            self._remove(theme, key, forget=False)
+
+            entries = self._themes.setdefault(theme, OrderedDict())
+            self._themes.move_to_end(theme)
+            entries[key] = (template, weight)
+            stats = self._get_stats(theme)
+            stats.templates += 1
+            stats.size += weight
+            self.size += weight
+
+            # Keep the theme within its quota, dropping its own least
+            # recently used templates first.
+            while stats.size > self.theme_quota and len(entries) > 1:
+                self._evict_one(theme)
+
+            # Then make room in the cache, starting with the coldest theme.
+            while self.size > self.max_size:
+                coldest = next(iter(self._themes))
+                if coldest == theme and len(entries) == 1:
+                    # Nothing is left but the new template.
+                    break
+                self._evict_one(coldest)
+
+    def _evict_one(self, theme: Optional[str]):
+        entries = self._themes[theme]
+        key = next(iter(entries))
+        self._stats[theme].evictions += 1
+        self._remove(theme, key)
+
+    def _remove(self, theme: Optional[str], key,
+                forget: bool = True) -> bool:
+        """Remove `key`, along with its theme's statistics if it was the
+        theme's last template, unless `forget` is False."""
+        entries = self._themes.get(theme)
+        if entries is None or key not in entries:
+            return False
+
+        _, weight = entries.pop(key)
+        stats = self._stats[theme]
+        stats.templates -= 1
+        stats.size -= weight
+        self.size -= weight
+
+        if not entries:
+            del self._themes[theme]
+            if forget:
+                del self._stats[theme]
+        return True
+
+    def __delitem__(self, key):
+        with self._lock:
+            if not self._remove(self._theme_of(key), key):
+                raise KeyError(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._themes.get(self._theme_of(key), ())
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(entries) for entries in self._themes.values())
+
+    def keys(self):
+        with self._lock:
+            return [
+                key for entries in self._themes.values() for key in entries
+            ]
+
+    def themes(self) -> List[str]:
+        """Returns the names of every theme with cached templates, least
+        recently used first."""
+        with self._lock:
+            return [theme for theme in self._themes if theme is not None]
+
+    def evict(self, theme: Optional[str]):
+        """Remove every template cached for `theme`."""
+        with self._lock:
+            for key in list(self._themes.get(theme, ())):
+                self._remove(theme, key)
+
+    def clear(self):
+        with self._lock:
+            for theme, entries in list(self._themes.items()):
+                for key in list(entries):
+                    self._remove(theme, key)
+
+    def stats(self) -> Dict[Optional[str], TemplateCacheStats]:
+        """Returns a copy of the usage statistics for every theme with cached
+        templates. A theme's statistics are dropped with its last cached
+        template."""
+        with self._lock:
+            return {
+                theme: dataclasses.replace(stats)
+                for theme, stats in self._stats.items()
+            }
+
+
+class ThemeBytecodeCache(BytecodeCache):
+    """A Jinja2 bytecode cache that stores compiled templates on disk under
+    `directory`, with a sub-directory for each theme.
+
+    Entries are keyed by the template's name, replacing the entry written
+    for an older version of the template, and are written atomically, so
+    the same directory can safely be shared by every worker process and
+    survives restarts. A single theme's entries can be removed with
+    `prune()`.
+    """
+    def __init__(self, directory: Union[Path, str]):
+        self.directory = Path(directory)
+
+    def _theme_directory(self, name: str) -> Path:
+        """Returns the directory holding entries for the template `name`."""
+        if name.startswith(f'{MAGIC_PATH_PREFIX}/'):
+            theme = name[len(MAGIC_PATH_PREFIX) + 1:].split('/', 1)[0]
+            return self.directory / f'theme-{quote(theme, safe="")}'
+        return self.directory / '_app'
+
+    def get_bucket(self, environment, name, filename, source):
+        # The bucket checks the checksum of the source when loading, so an
+        # entry for an older version of the template is simply ignored
+        # until it's overwritten.
+        key = self.get_cache_key(name, filename)
+        bucket = Bucket(
+            environment,
+            str(self._theme_directory(name) / f'{key}.cache'),
+            self.get_source_checksum(source)
+        )
+        self.load_bytecode(bucket)
+        return bucket
+
+    def load_bytecode(self, bucket):
+        try:
+            with open(bucket.key, 'rb') as fin:
+                bucket.load_bytecode(fin)
+        except OSError:
+            return
+
+    def dump_bytecode(self, bucket):
+        directory = os.path.dirname(bucket.key)
+        os.makedirs(directory, exist_ok=True)
+
+        # Write to a temporary file first and move it into place, so other
+        # processes never see a partially written entry.
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                bucket.write_bytecode(fout)
+            os.replace(tmp_path, bucket.key)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def prune(self, theme: str):
+        """Remove every entry for `theme`."""
+        shutil.rmtree(
+            self._theme_directory(f'{MAGIC_PATH_PREFIX}/{theme}/'),
+            ignore_errors=True
+        )
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def compress_static_file(path: str,
+                         force: bool = False) -> List[Tuple[str, int, int]]:
+    """Write precompressed copies of the file at `path` next to it, for each
+    encoding in `PRECOMPRESSED_ENCODINGS` that's available.
+
+    Copies that are newer than the file are left alone unless `force` is
+    True, and copies that wouldn't be smaller than the file aren't written
+    (removing any out of date copy instead). Copies are written to a
+    temporary file first, so a running server never sees a partial copy.
+    Returns a list of (path, original size, compressed size) for every copy
+    written.
+    """
+    written = []
+    data = None
+    for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+        if encoding == 'br' and brotli is None:
+            continue
+
+        sidecar = path + suffix
+        if not force and os.path.exists(sidecar) and \
+                os.path.getmtime(sidecar) >= os.path.getmtime(path):
+            continue
+
+        if data is None:
+            with open(path, 'rb') as fin:
+                data = fin.read()
+
+        if encoding == 'br':
+            compressed = brotli.compress(data)
+        else:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+
+        if len(compressed) >= len(data):
+            try:
+                os.remove(sidecar)
+            except FileNotFoundError:
+                pass
+            continue
+
+        # Keep the encoding's suffix, so a temporary file left behind isn't
+        # mistaken for a static asset itself.
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path),
+            prefix=f'.{os.path.basename(path)}.',
+            suffix=suffix
+        )
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                fout.write(compressed)
+            shutil.copymode(path, temp_path)
+            os.replace(temp_path, sidecar)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        written.append((sidecar, len(data), len(compressed)))
+
+    return written
+
+
+@dataclass
+class WarmupReport:
+    #: The number of templates that were compiled.
+    compiled: int
+    #: Templates that failed to compile, mapped to the exception raised.
+    errors: Dict[str, Exception]
+    #: The total time spent, in seconds.
+    elapsed: float
+    #: The time spent on each template, in seconds, slowest first.
+    timings: List[Tuple[str, float]]
+
+
+class Metrics:
+    """A thread-safe registry of counters and latency histograms, each
+    identified by a name and a set of labels.
+
+    Everything recorded can be read back as a plain dict with `snapshot()`,
+    or exported in the Prometheus text format with `to_prometheus()`.
+    """
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        #: The upper bounds of the buckets used by histograms, in seconds.
+        self.buckets = tuple(sorted(buckets))
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._histograms: Dict[str, Dict[tuple, list]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        """Increase the counter `name` by `amount`."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        """Record `value` in the histogram `name`."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self._histograms.setdefault(name, {})
+            # The count in each bucket, followed by the sum of all values.
+            values = histogram.get(key)
+            if values is None:
+                values = histogram[key] = [0] * (len(self.buckets) + 1) + [0.0]
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+
+            values[i] += 1
+            values[-1] += value
+
+    def reset(self):
+        """Forget everything that's been recorded."""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self) -> dict:
+        """Return a copy of everything that's been recorded.
+
+        Counters are mapped to a list of `{'labels': ..., 'value': ...}`,
+        and histograms to a list of `{'labels': ..., 'count': ..., 'sum':
+        ..., 'buckets': ...}`, where `buckets` maps each upper bound to the
+        number of values less than or equal to it.
+        """
+        with self._lock:
+            counters = {
+                name: [
+                    {'labels': dict(key), 'value': value}
+                    for key, value in sorted(counter.items())
+                ]
+                for name, counter in sorted(self._counters.items())
+            }
+            histograms = {
+                name: [
+                    self._histogram_snapshot(key, values)
+                    for key, values in sorted(histogram.items())
+                ]
+                for name, histogram in sorted(self._histograms.items())
+            }
+
+        return {'counters': counters, 'histograms': histograms}
+
+    def _histogram_snapshot(self, key: tuple, values: list) -> dict:
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), values):
+            total += count
+            buckets[bound] = total
+
+        return {
+            'labels': dict(key),
+            'count': total,
+            'sum': values[-1],
+            'buckets': buckets
+        }
+
+    def to_prometheus(self) -> str:
+        """Return everything that's been recorded in the Prometheus text
+        exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+
+        for name, samples in snapshot['counters'].items():
+            lines.extend(_prometheus_header(name, 'counter'))
+            for sample in samples:
+                lines.append(
+                    f'{name}{_prometheus_labels(sample["labels"])} '
+                    f'{_prometheus_value(sample["value"])}'
+                )
+
+        for name, samples in snapshot['histograms'].items():
+            lines.extend(_prometheus_header(name, 'histogram'))
+            for sample in samples:
+                for bound, count in sample['buckets'].items():
+                    labels = _prometheus_labels(
+                        sample['labels'],
+                        le=_prometheus_value(bound)
+                    )
+                    lines.append(f'{name}_bucket{labels} {count}')
+
+                labels = _prometheus_labels(sample['labels'])
+                lines.append(
+                    f'{name}_sum{labels} {_prometheus_value(sample["sum"])}'
+                )
+                lines.append(f'{name}_count{labels} {sample["count"]}')
+
+        return ''.join(f'{line}\n' for line in lines)
+
+
+def _prometheus_header(name: str, kind: str) -> List[str]:
+    lines = []
+    if name in METRIC_DESCRIPTIONS:
+        lines.append(f'# HELP {name} {METRIC_DESCRIPTIONS[name]}')
+    lines.append(f'# TYPE {name} {kind}')
+    return lines
+
+
+def _prometheus_labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace(
+            '"', '\\"'
+        ).replace('\n', '\\n')
+
+    return '{' + ','.join(
+        f'{key}="{escape(value)}"' for key, value in labels.items()
+    ) + '}'
+
+
+def _prometheus_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Themer:
+    def __init__(self, app=None, *, loaders=None):
+        self.loaders = []
+        #: Themes discovered by `init_app`, mapped by name. Themes from lazy
+        #: loaders aren't included, use `get_theme()` to find any theme.
+        self.themes = {}
+        self._theme_resolver = None
+        #: Loaders whose themes are found on demand, highest precedence
+        #: first.
+        self._lazy_loaders = []
+        #: Recently used themes from lazy loaders, least recently used first.
+        self._lazy_themes = OrderedDict()
+        self._lazy_themes_lock = threading.Lock()
+        self._lazy_themes_size = 1024
+        #: Themes set by `use_theme`, kept in a context variable so that
+        #: concurrent requests on other threads, greenlets or tasks never see
+        #: each other's overrides.
+        self._explicit_theme_stack = ContextVar(
+            f'{EXTENSION_KEY}_explicit_theme_stack_{id(self)}',
+            default=()
+        )
+        #: Maps theme names to a dict of template paths and the name of the
+        #: theme in its inheritance chain that provides each one, or `None`
+        #: if the app's own template should be used.
+        self._resolved = {}
+        #: An optional `StaticCache` of static asset responses, enabled by
+        #: setting `THEMER_STATIC_CACHE_SIZE`.
+        self.static_cache = None
+        #: An optional `Metrics` registry, enabled by setting
+        #: `THEMER_METRICS` or `THEMER_METRICS_ENDPOINT`.
+        self.metrics = None
+        #: URLs built by `lookup_static_theme_path`, keyed by everything
+        #: that can change the URL.
+        self._static_urls = {}
+        self._static_urls_size = 4096
+        #: Identifies the URL map, and the rules for static assets in it,
+        #: that the cached URLs were built with.
+        self._static_urls_map = None
+        #: An async mode copy of the app's Jinja environment, used by
+        #: `render_template_async` and created the first time it's needed.
+        self._async_env = None
+
+        if app is not None:
+            self.init_app(app, loaders=loaders)
+
+    def init_app(self, app, *, loaders=None):
+        """Configure `app` to work with Flask-Themer and pre-populate the
+        list of themes we know about."""
+        app.extensions[EXTENSION_KEY] = self
+
+        default_dir = app.config.setdefault(
+            f'{CONFIG_PREFIX}DEFAULT_DIRECTORY',
+            'themes'
+        )
+        app.config.setdefault(f'{CONFIG_PREFIX}CACHE_CURRENT_THEME', True)
+        app.config.setdefault(f'{CONFIG_PREFIX}DIRECT_DISPATCH', False)
+        app.config.setdefault(f'{CONFIG_PREFIX}STATIC_FINGERPRINT', False)
+        app.config.setdefault(f'{CONFIG_PREFIX}STATIC_CACHE_SIZE', 0)
+        app.config.setdefault(
+            f'{CONFIG_PREFIX}STATIC_CACHE_MAX_FILE_SIZE',
+            256 * 1024
+        )
+        app.config.setdefault(f'{CONFIG_PREFIX}BYTECODE_CACHE_DIR', None)
+        app.config.setdefault(f'{CONFIG_PREFIX}PRECOMPILED_DIR', None)
+        app.config.setdefault(f'{CONFIG_PREFIX}WARMUP', False)
+        app.config.setdefault(f'{CONFIG_PREFIX}WARMUP_THEMES', None)
+        app.config.setdefault(f'{CONFIG_PREFIX}LAZY_THEME_CACHE_SIZE', 1024)
+        app.config.setdefault(f'{CONFIG_PREFIX}METRICS', False)
+        app.config.setdefault(f'{CONFIG_PREFIX}METRICS_ENDPOINT', None)
+        app.config.setdefault(f'{CONFIG_PREFIX}STATIC_URL_CACHE_SIZE', 4096)
+        app.config.setdefault(f'{CONFIG_PREFIX}TEMPLATE_CACHE_SIZE', None)
+        app.config.setdefault(
+            f'{CONFIG_PREFIX}TEMPLATE_CACHE_THEME_QUOTA',
+            None
+        )
+
+        app.add_template_global(lookup_theme_path, name='theme')
+        app.add_template_global(lookup_static_theme_path, name='theme_static')
+        app.register_blueprint(theme_blueprint)
+        app.cli.add_command(themer_cli)
+
+        if app.config[f'{CONFIG_PREFIX}BYTECODE_CACHE_DIR']:
+            app.jinja_env.bytecode_cache = ThemeBytecodeCache(
+                app.config[f'{CONFIG_PREFIX}BYTECODE_CACHE_DIR']
+            )
+
+        if app.config[f'{CONFIG_PREFIX}TEMPLATE_CACHE_SIZE']:
+            app.jinja_env.cache = ThemedTemplateCache(
+                app.config[f'{CONFIG_PREFIX}TEMPLATE_CACHE_SIZE'],
+                app.config[f'{CONFIG_PREFIX}TEMPLATE_CACHE_THEME_QUOTA']
+            )
+
+        if app.config[f'{CONFIG_PREFIX}STATIC_CACHE_SIZE']:
+            self.static_cache = StaticCache(
+                app.config[f'{CONFIG_PREFIX}STATIC_CACHE_SIZE'],
+                app.config[f'{CONFIG_PREFIX}STATIC_CACHE_MAX_FILE_SIZE']
+            )
+
+        metrics_endpoint = app.config[f'{CONFIG_PREFIX}METRICS_ENDPOINT']
+        if app.config[f'{CONFIG_PREFIX}METRICS'] or metrics_endpoint:
+            self.metrics = Metrics()
+
+        if metrics_endpoint:
+            app.add_url_rule(
+                metrics_endpoint,
+                endpoint='themer_metrics',
+                view_func=metrics_view
+            )
+
+        precompiled_dir = app.config[f'{CONFIG_PREFIX}PRECOMPILED_DIR']
+        if app.config[f'{CONFIG_PREFIX}DIRECT_DISPATCH'] or precompiled_dir:
+            # This creates the app's Jinja environment, after which Flask
+            # ignores any changes to `app.jinja_options`.
+            app.jinja_env.loader = _DirectDispatchLoader(
+                app.jinja_env.loader,
+                module_loader=(
+                    ModuleLoader(precompiled_dir) if precompiled_dir else None
+                )
+            )
+
+        self.loaders = loaders or [
+            FileSystemThemeLoader(Path(app.root_path) / default_dir)
+        ]
+
+        self._lazy_loaders = [
+            loader for loader in reversed(self.loaders) if loader.lazy
+        ]
+        self._lazy_themes_size = app.config[
+            f'{CONFIG_PREFIX}LAZY_THEME_CACHE_SIZE'
+        ]
+        self._static_urls_size = app.config[
+            f'{CONFIG_PREFIX}STATIC_URL_CACHE_SIZE'
+        ]
+        self.themes = self._discover(app)
+
+        if app.config[f'{CONFIG_PREFIX}WARMUP']:
+            self.warmup(
+                app,
+                themes=app.config[f'{CONFIG_PREFIX}WARMUP_THEMES']
+            )
+
+    def _discover(self, app):
+        """Ask every loader that isn't lazy for its themes, with later loaders
+        taking precedence over earlier ones.
+
+        Loaders are asked at the same time, each in its own thread, so slow
+        loaders don't hold each other up.
+        """
+        def discover(loader):
+            started = time.perf_counter()
+            themes = list(loader.themes)
+            app.logger.debug(
+                'Discovered %d themes from %r in %.3fs.',
+                len(themes),
+                loader,
+                time.perf_counter() - started
+            )
+            return themes
+
+        loaders = [loader for loader in self.loaders if not loader.lazy]
+        if len(loaders) > 1:
+            with ThreadPoolExecutor(max_workers=len(loaders)) as executor:
+                results = list(executor.map(discover, loaders))
+        else:
+            results = [discover(loader) for loader in loaders]
+
+        themes = {}
+        for loader_themes in results:
+            for theme in loader_themes:
+                themes[theme.name] = theme
+        return themes
+
+    def get_theme(self, name):
+        """Return the theme called `name`, or `None` if no loader provides
+        it.
+
+        Themes discovered by `init_app` take precedence. Otherwise each lazy
+        loader is asked for the theme, and the result is kept in a bounded
+        cache of recently used themes (`THEMER_LAZY_THEME_CACHE_SIZE`).
+        """
+        theme = self.themes.get(name)
+        if theme is not None or not self._lazy_loaders:
+            return theme
+
+        with self._lazy_themes_lock:
+            theme = self._lazy_themes.get(name)
+            if theme is not None:
+                self._lazy_themes.move_to_end(name)
+                return theme
+
+        for loader in self._lazy_loaders:
+            theme = loader.get_theme(name)
+            if theme is not None:
+                break
+        else:
+            return None
+
+        with self._lazy_themes_lock:
+            self._lazy_themes[name] = theme
+            while len(self._lazy_themes) > self._lazy_themes_size:
+                evicted, _ = self._lazy_themes.popitem(last=False)
+                self._resolved.pop(evicted, None)
+
+        return theme
+
+    def _theme_chain(self, name) -> List[Theme]:
+        """Returns the theme called `name` followed by each of its parents,
+        as declared by the `parent` key of `Theme.data`.
+
+        The chain stops at the first parent that can't be found, and is empty
+        if the theme itself can't be found.
+        """
+        chain: List[Theme] = []
+        theme = self.get_theme(name)
+        while theme is not None:
+            if any(t.name == theme.name for t in chain):
+                raise ThemeError(
+                    f'The theme {name} inherits from itself through '
+                    f'{" -> ".join(t.name for t in chain)}.'
+                )
+
+            chain.append(theme)
+            parent = theme.data.get('parent')
+            theme = self.get_theme(parent) if parent else None
+
+        return chain
+
+    def resolve_template(self, theme, path):
+        """Return the name of the theme that provides the template `path` when
+        `theme` is active, or `None` if the app's own template should be
+        used.
+
+        The theme is checked first, followed by its parents, grandparents and
+        so on. The result is remembered, so later lookups of the same
+        template are a dictionary lookup, unless Jinja's `auto_reload` is
+        enabled.
+        """
+        try:
+            return self._resolved[theme][path]
+        except KeyError:
+            pass
+
+        chain = self._theme_chain(theme)
+        if not chain:
+            # Don't remember anything about themes that don't exist.
+            return None
+
+        environment = current_app.jinja_env
+
+        owner = None
+        for t in chain:
+            # Loaders that can cheaply tell if they have a template, such as
+            # an IndexedFileSystemLoader, don't need to load it to find out.
+            contains = getattr(t.jinja_loader, '__contains__', None)
+            if contains is not None:
+                found = contains(path)
+            else:
+                try:
+                    t.jinja_loader.get_source(environment, path)
+                    found = True
+                except TemplateNotFound:
+                    found = False
+
+            if found:
+                owner = t.name
+                break
+
+        if not environment.auto_reload:
+            self._resolved.setdefault(theme, {})[path] = owner
+
+        return owner
+
+    def _dependents(self, theme) -> List[str]:
+        """Returns `theme` and the names of every known theme that inherits
+        from it."""
+        with self._lazy_themes_lock:
+            known = list(self._lazy_themes.values())
+        known.extend(self.themes.values())
+
+        dependents = {theme}
+        for t in known:
+            try:
+                chain = self._theme_chain(t.name)
+            except ThemeError:
+                continue
+
+            if any(parent.name == theme for parent in chain):
+                dependents.add(t.name)
+
+        return sorted(dependents)
+
+    def iter_themes(self):
+        """Yield every theme from every loader, including lazy ones.
+
+        Themes from lazy loaders are streamed from the loader rather than
+        being kept, so this can be used with any number of themes, but may be
+        slow.
         """
-        Return a static asset for the given theme and path.
+        seen = set(self.themes)
+        yield from self.themes.values()
+
+        for loader in self._lazy_loaders:
+            for theme in loader.themes:
+                if theme.name not in seen:
+                    seen.add(theme.name)
+                    yield theme
+
+    def refresh(self, app=None):
+        """Rediscover the themes provided by every loader, picking up themes
+        that have been added or removed since `init_app` was called.
+
+        Themes that already existed keep their current `Theme` instance, and
+        their caches are left alone. Returns the names of themes that were
+        added or removed.
         """
-        raise NotImplementedError
+        themes = self._discover(app or current_app._get_current_object())
+        for name, theme in themes.items():
+            existing = self.themes.get(name)
+            if existing and existing.theme_loader is theme.theme_loader:
+                themes[name] = existing
 
+        changed = themes.keys() ^ self.themes.keys()
+        self.themes = themes
 
-class FileSystemThemeLoader(ThemeLoader):
-    """A simple theme loader that assumes all sub-directories immediately under
-    `path` are themes.
-    """
-    def __init__(self, path: Union[Path, str],
-                 filter: Optional[Callable[[Path], bool]] = None):
-        #: The path the loader is searching for themes.
-        self.path = Path(path)
-        self._filter = filter
+        # Lazy themes are cheap to find again, so just start over.
+        with self._lazy_themes_lock:
+            self._lazy_themes.clear()
 
-    @property
-    def themes(self):
-        themes = {}
-        if self.path.exists():
-            for child in self.path.iterdir():
-                if not child.is_dir():
-                    continue
+        for name in changed:
+            self.invalidate(name)
 
-                if self._filter and not self._filter(child):
-                    continue
+        return sorted(changed)
 
-                yield Theme(
-                    jinja_loader=FileSystemLoader(str(child)),
-                    theme_loader=self,
-                    name=child.name
-                )
+    def warmup(self, app=None, *, themes=None, workers=None) -> WarmupReport:
+        """Compile every template of every theme, or just those in `themes`,
+        into the Jinja environment's template cache using a pool of `workers`
+        threads, so that requests never have to.
 
-        return themes
+        Static assets and themes whose loaders can't list their templates are
+        skipped. Returns a `WarmupReport`, and logs a summary to the app's
+        logger. This can be done automatically at the end of `init_app` by
+        setting `THEMER_WARMUP` (and optionally `THEMER_WARMUP_THEMES`).
+        """
+        app = app or current_app._get_current_object()  # type: ignore
+        started = time.perf_counter()
 
-    def get_static(self, theme, path):
-        return send_from_directory(self.path / theme / 'static', path)
+        names: List[str] = []
+        for theme in self.themes.values():
+            if themes is not None and theme.name not in themes:
+                continue
 
+            try:
+                paths = theme.jinja_loader.list_templates()
+            except TypeError:
+                app.logger.warning(
+                    'Not warming up theme %s, its loader can\'t list '
+                    'templates.',
+                    theme.name
+                )
+                continue
 
-class Themer:
-    def __init__(self, app=None, *, loaders=None):
-        self.loaders = []
-        self.themes = {}
-        self._theme_resolver = None
-        self._explicit_theme_stack = []
+            names.extend(
+                f'{MAGIC_PATH_PREFIX}/{theme.name}/{path}'
+                for path in paths if not path.startswith('static/')
+            )
 
-        if app is not None:
-            self.init_app(app, loaders=loaders)
+        # A ThemedTemplateCache is limited by the size of its templates
+        # rather than their number.
+        cache = app.jinja_env.cache
+        capacity = None if isinstance(cache, ThemedTemplateCache) else \
+            getattr(cache, 'capacity', None)
+        if capacity is not None and len(names) > capacity:
+            app.logger.warning(
+                'Warming up %d templates, but the template cache only holds '
+                '%d. Consider increasing its size.',
+                len(names),
+                capacity
+            )
 
-    def init_app(self, app, *, loaders=None):
-        """Configure `app` to work with Flask-Themer and pre-populate the
-        list of themes we know about."""
-        app.extensions[EXTENSION_KEY] = self
+        def load(name):
+            start = time.perf_counter()
+            with app.app_context():
+                app.jinja_env.get_template(name)
+            return time.perf_counter() - start
 
-        default_dir = app.config.setdefault(
-            f'{CONFIG_PREFIX}DEFAULT_DIRECTORY',
-            'themes'
-        )
+        timings: List[Tuple[str, float]] = []
+        errors: Dict[str, Exception] = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(load, name): name for name in names}
+            for future in as_completed(futures):
+                try:
+                    timings.append((futures[future], future.result()))
+                except Exception as e:
+                    errors[futures[future]] = e
 
-        app.add_template_global(lookup_theme_path, name='theme')
-        app.add_template_global(lookup_static_theme_path, name='theme_static')
-        app.register_blueprint(theme_blueprint)
+        timings.sort(key=lambda timing: timing[1], reverse=True)
+        report = WarmupReport(
+            compiled=len(timings),
+            errors=errors,
+            elapsed=time.perf_counter() - started,
+            timings=timings
+        )
 
-        self.loaders = loaders or [
-            FileSystemThemeLoader(Path(app.root_path) / default_dir)
-        ]
+        app.logger.info(
+            'Warmed up %d templates in %.3fs (%d failed).',
+            report.compiled,
+            report.elapsed,
+            len(report.errors)
+        )
+        for name, error in errors.items():
+            app.logger.warning('Failed to warm up %s: %s', name, error)
 
-        for loader in self.loaders:
-            for theme in loader.themes:
-                self.themes[theme.name] = theme
+        return report
 
     def current_theme_loader(self, loader):
         """Set the resolver to use when looking up the currently active
@@ -137,65 +1936,436 @@ class Themer:
                 @themer.current_theme_loader
                 def get_current_theme():
                     return current_user.settings.theme
+
+        Unless `THEMER_CACHE_CURRENT_THEME` is disabled, the resolver is only
+        called once per request (or app context), and the result is reused
+        until `forget_current_theme()` is called.
+
+        The resolver can also be a coroutine function, in which case the
+        theme can only be resolved from coroutines, using
+        `current_theme_async()` or `render_template_async()`.
         """
         self._theme_resolver = loader
+        self.forget_current_theme()
         return loader
 
     @property
     def current_theme(self):
         """The currently active theme."""
-        if self._explicit_theme_stack:
-            return self._explicit_theme_stack[-1]
+        explicit_theme_stack = self._explicit_theme_stack.get()
+        if explicit_theme_stack:
+            return explicit_theme_stack[-1]
+
+        self._require_resolver()
+
+        if not has_app_context() or \
+                not current_app.config[f'{CONFIG_PREFIX}CACHE_CURRENT_THEME']:
+            return self._resolve_current_theme()
+
+        try:
+            return getattr(g, _CURRENT_THEME_ATTR)
+        except AttributeError:
+            theme = self._resolve_current_theme()
+            setattr(g, _CURRENT_THEME_ATTR, theme)
+            return theme
+
+    async def current_theme_async(self):
+        """The currently active theme, for use from coroutines.
 
+        Works just like `current_theme`, except that the resolver can be a
+        coroutine function, which is awaited.
+        """
+        explicit_theme_stack = self._explicit_theme_stack.get()
+        if explicit_theme_stack:
+            return explicit_theme_stack[-1]
+
+        self._require_resolver()
+
+        cache = has_app_context() and \
+            current_app.config[f'{CONFIG_PREFIX}CACHE_CURRENT_THEME']
+        if cache:
+            try:
+                return getattr(g, _CURRENT_THEME_ATTR)
+            except AttributeError:
+                pass
+
+        started = time.perf_counter()
+        try:
+            theme = self._theme_resolver()
+            if inspect.isawaitable(theme):
+                theme = await theme
+        finally:
+            self._record_resolver(started)
+
+        if cache:
+            setattr(g, _CURRENT_THEME_ATTR, theme)
+        return theme
+
+    def _require_resolver(self):
         if not self._theme_resolver:
             raise NoThemeResolver(
                 'No current theme resolver is registered, set one using '
                 'current_theme_loader.'
             )
 
-        return self._theme_resolver()
+    def _resolve_current_theme(self):
+        """Call the current theme resolver, recording how long it took."""
+        started = time.perf_counter()
+        try:
+            theme = self._theme_resolver()
+        finally:
+            self._record_resolver(started)
+
+        if inspect.isawaitable(theme):
+            if inspect.iscoroutine(theme):
+                # Avoid a warning about the coroutine never being awaited.
+                theme.close()
+            raise ThemeError(
+                'The current theme resolver is asynchronous, so the theme '
+                'can only be resolved from coroutines. Use '
+                'render_template_async or current_theme_async.'
+            )
+
+        return theme
+
+    def _record_resolver(self, started: float):
+        if self.metrics is not None:
+            self.metrics.inc('themer_resolver_calls_total')
+            self.metrics.observe(
+                'themer_resolver_seconds',
+                time.perf_counter() - started
+            )
+
+    def _async_environment(self, app):
+        """Returns a copy of `app`'s Jinja environment with async mode
+        enabled, creating it the first time it's needed."""
+        env = self._async_env
+        if env is None or env.linked_to is not app.jinja_env:
+            cache = app.jinja_env.cache
+            loader = app.jinja_env.loader
+            if isinstance(loader, _DirectDispatchLoader) and \
+                    loader.module_loader is not None:
+                # Precompiled modules are compiled for the sync environment
+                # and can't be run in async mode, so compile from source.
+                loader = _DirectDispatchLoader(loader.loader)
+
+            env = self._async_env = app.jinja_env.overlay(
+                enable_async=True,
+                loader=loader,
+                # Templates compiled for async mode can't be shared with the
+                # app's own environment, so they get their own caches.
+                cache_size=0 if cache is None else getattr(
+                    cache, 'capacity', -1
+                ),
+                bytecode_cache=None
+            )
+            if isinstance(cache, ThemedTemplateCache):
+                env.cache = cache.copy()
+        return env
+
+    def forget_current_theme(self):
+        """Forget the theme remembered for the current request, if any, so
+        the next lookup calls the resolver again.
+
+        Call this after changing something the resolver depends on, such as
+        the current user's theme preference, part way through a request.
+        """
+        if has_app_context():
+            g.pop(_CURRENT_THEME_ATTR, None)
+
+    def invalidate(self, theme=None):
+        """Forget any cached template lookups, compiled templates and static
+        assets for `theme`, or for every theme if no theme is given.
+
+        Themes inheriting from `theme` may be using its templates, so their
+        template lookups and compiled templates are forgotten too.
+
+        Call this after templates or static assets have been added to,
+        removed from or changed in a theme at runtime.
+        """
+        if theme is None:
+            self._resolved.clear()
+            affected = []
+            prefixes = (MAGIC_PATH_PREFIX,)
+        else:
+            affected = self._dependents(theme)
+            for name in affected:
+                self._resolved.pop(name, None)
+            prefixes = tuple(
+                f'{MAGIC_PATH_PREFIX}/{name}/' for name in affected
+            )
+
+        # Lazy themes will be found again, fresh, the next time they're used.
+        with self._lazy_themes_lock:
+            if theme is None:
+                self._lazy_themes.clear()
+            else:
+                self._lazy_themes.pop(theme, None)
+
+        for loader in self.loaders:
+            loader.invalidate(theme)
+
+        if self.static_cache is not None:
+            self.static_cache.evict(theme)
+
+        if theme is None:
+            self._static_urls.clear()
+        else:
+            for key in [k for k in list(self._static_urls) if k[0] == theme]:
+                self._static_urls.pop(key, None)
+
+        if not has_app_context():
+            return
+
+        bytecode_cache = current_app.jinja_env.bytecode_cache
+        if isinstance(bytecode_cache, ThemeBytecodeCache):
+            if theme is None:
+                bytecode_cache.clear()
+            for name in affected:
+                bytecode_cache.prune(name)
+
+        caches = [current_app.jinja_env.cache]
+        if self._async_env is not None:
+            caches.append(self._async_env.cache)
+
+        for cache in caches:
+            if cache is None:
+                continue
+
+            if isinstance(cache, ThemedTemplateCache):
+                for name in (affected if theme else cache.themes()):
+                    cache.evict(name)
+                continue
+
+            for key in list(cache.keys()):
+                if key[1].startswith(prefixes):
+                    try:
+                        del cache[key]
+                    except KeyError:
+                        # Already evicted by another thread.
+                        pass
 
 
 def render_template(path, *args, **kwargs):
     """Identical to flask's render_template, but loads from the active theme if
     one is available.
     """
-    try:
-        return flask_render_template(lookup_theme_path(path), *args, **kwargs)
-    except TemplateNotFound:
-        return flask_render_template(path, *args, **kwargs)
+    return _render_themed(flask_render_template, path, args, kwargs)
+
+
+def stream_template(path, *args, **kwargs):
+    """Identical to flask's stream_template, but loads from the active theme if
+    one is available.
+
+    The template is rendered in chunks as the response is sent, rather than
+    all at once. Only templates that can't be loaded up front fall back to
+    the app's own templates, since by the time anything else goes missing,
+    part of the page may already have been sent.
+    """
+    return _render_themed(flask_stream_template, path, args, kwargs)
+
+
+def _render_themed(render, path, args, kwargs):
+    """Render `path` using `render`, from the active theme if it provides the
+    template, and from the app's own templates otherwise."""
+    themer = _current_themer()
+    theme = themer.current_theme
+
+    owner = themer.resolve_template(theme, path)
+    if owner is not None:
+        try:
+            rendered = render(
+                f'{MAGIC_PATH_PREFIX}/{owner}/{path}',
+                *args,
+                **kwargs
+            )
+        except TemplateNotFound:
+            # Something the themed template tried to include is missing.
+            pass
+        else:
+            _record_render(themer, theme, 'hit')
+            return rendered
+
+    _record_render(themer, theme, 'fallback')
+    return render(path, *args, **kwargs)
+
+
+async def render_template_async(path, *args, **kwargs):
+    """Identical to `render_template`, but renders using Jinja's async mode,
+    for use from async views.
+
+    The theme is resolved with `Themer.current_theme_async()`, so the
+    resolver can be a coroutine function. Looking up, loading and compiling
+    the template happens in a thread pool, so slow theme loaders don't block
+    the event loop. Templates it includes or extends are loaded while
+    rendering, which only blocks the first time each one is used.
+    """
+    themer = _current_themer()
+    theme = await themer.current_theme_async()
+    app = current_app._get_current_object()
+    environment = themer._async_environment(app)
+    context = dict(*args, **kwargs)
+
+    # Anything the template does to look up the theme, such as calling
+    # `theme()`, has to use the theme we've already resolved.
+    with use_theme(theme):
+        owner = await _run_in_thread(themer.resolve_template, theme, path)
+        if owner is not None:
+            try:
+                rendered = await _render_async(
+                    app,
+                    environment,
+                    f'{MAGIC_PATH_PREFIX}/{owner}/{path}',
+                    dict(context)
+                )
+            except TemplateNotFound:
+                # Something the themed template tried to include is missing.
+                pass
+            else:
+                _record_render(themer, theme, 'hit')
+                return rendered
+
+        _record_render(themer, theme, 'fallback')
+        return await _render_async(app, environment, path, context)
+
+
+async def _render_async(app, environment, name, context):
+    template = await _run_in_thread(environment.get_or_select_template, name)
+    app.update_template_context(context)
+    before_render_template.send(app, template=template, context=context)
+    rendered = await template.render_async(context)
+    template_rendered.send(app, template=template, context=context)
+    return rendered
+
+
+async def _run_in_thread(func, *args):
+    """Call `func` in the event loop's default thread pool, keeping the
+    current context, including Flask's app and request contexts."""
+    return await asyncio.get_running_loop().run_in_executor(
+        None,
+        functools.partial(copy_context().run, func, *args)
+    )
+
+
+def _record_render(themer: Themer, theme: str, result: str):
+    if themer.metrics is not None:
+        themer.metrics.inc('themer_render_total', theme=theme, result=result)
 
 
 def lookup_theme_path(path, theme=None):
     """Given the path to a template, lookup the "real" path after resolving the
     active theme.
+
+    Templates a theme inherits from a parent theme are given the parent's
+    path, so every theme inheriting the template shares a single compiled
+    copy of it.
     """
     themer = _current_themer()
     theme = theme or themer.current_theme
-    return f'{MAGIC_PATH_PREFIX}/{theme}/{path}'
+    owner = themer.resolve_template(theme, path)
+    return f'{MAGIC_PATH_PREFIX}/{owner or theme}/{path}'
 
 
 def lookup_static_theme_path(path, theme=None, **kwargs):
+    """Given the path to a static asset, lookup its URL after resolving the
+    active theme.
+
+    If `THEMER_STATIC_FINGERPRINT` is enabled, a fingerprint of the asset's
+    contents is added to the URL so it can be cached forever by clients.
+
+    Built URLs are remembered (up to `THEMER_STATIC_URL_CACHE_SIZE` of
+    them), so repeated lookups of the same asset skip `url_for`. The cache
+    is bypassed when the app has `url_defaults` functions that could apply,
+    since they may change the URL from one request to the next.
+    """
     themer = _current_themer()
     theme = theme or themer.current_theme
-    return url_for(
+
+    if current_app.config[f'{CONFIG_PREFIX}STATIC_FINGERPRINT']:
+        t = themer.get_theme(theme)
+        digest = t.theme_loader.get_static_digest(theme, path) if t else None
+        if digest:
+            kwargs[FINGERPRINT_ARG] = digest[:FINGERPRINT_LENGTH]
+
+    key = _static_url_key(themer, theme, path, kwargs)
+    if key is not None:
+        try:
+            return themer._static_urls[key]
+        except KeyError:
+            pass
+
+    url = url_for(
         f'{MAGIC_PATH_PREFIX}.static',
         theme=theme,
         filename=path,
         **kwargs
     )
 
+    if key is not None:
+        if len(themer._static_urls) >= themer._static_urls_size:
+            themer._static_urls.clear()
+        themer._static_urls[key] = url
+
+    return url
+
+
+def _static_url_key(themer: Themer, theme: str, path: str,
+                    kwargs: dict) -> Optional[tuple]:
+    """Returns the key used to cache the URL of a static asset, or `None` if
+    it shouldn't be cached."""
+    if not themer._static_urls_size:
+        return None
+
+    app = current_app._get_current_object()  # type: ignore
+    if app.url_default_functions.get(None) or \
+            app.url_default_functions.get(MAGIC_PATH_PREFIX):
+        return None
+
+    # Only the rules for our own endpoint can change the URLs we build, and
+    # there are only ever a few of them, however many routes the app has.
+    try:
+        rules = tuple(app.url_map.iter_rules(f'{MAGIC_PATH_PREFIX}.static'))
+    except KeyError:
+        return None
+
+    url_map = (id(app.url_map), rules)
+    if url_map != themer._static_urls_map:
+        themer._static_urls.clear()
+        themer._static_urls_map = url_map
+
+    if has_request_context():
+        # The URL adapter for a request is bound to its host, scheme and
+        # the path the app is mounted at.
+        context: tuple = (request.host, request.scheme, request.root_path)
+    else:
+        context = (
+            app.config['SERVER_NAME'],
+            app.config['APPLICATION_ROOT'],
+            app.config['PREFERRED_URL_SCHEME']
+        )
+
+    try:
+        return (theme, path, frozenset(kwargs.items()), context)
+    except TypeError:
+        # One of the arguments can't be used as part of a key, like a list
+        # of values for a query argument.
+        return None
+
 
 @contextmanager
 def use_theme(theme):
-    """Temporarily override the theme."""
+    """Temporarily override the theme.
+
+    The override only applies to the current thread, greenlet or task.
+    """
     themer = _current_themer()
+    stack = themer._explicit_theme_stack
 
+    token = stack.set(stack.get() + (theme,))
     try:
-        themer._explicit_theme_stack.append(theme)
         yield
     finally:
-        themer._explicit_theme_stack.pop()
+        stack.reset(token)
 
 
 def _current_themer() -> Themer:
@@ -223,22 +2393,75 @@ class _ThemeTemplateLoader(BaseLoader):
         if not template.startswith(MAGIC_PATH_PREFIX):
             raise TemplateNotFound(template)
 
+        themer = _current_themer()
+
         path = template[len(MAGIC_PATH_PREFIX) + 1:]
         try:
             theme, path = path.split('/', 1)
         except ValueError:
             # Much cheaper to catch the occasional error than it is to check
             # each time in the off chance we get here with a bad path.
+            _record_miss(themer, 'bad_path')
             raise TemplateNotFound(template)
 
-        themer = _current_themer()
-        if theme in themer.themes:
-            return themer.themes[theme].jinja_loader.get_source(
+        owner = themer.resolve_template(theme, path)
+        if owner is None:
+            if themer.metrics is not None:
+                _record_miss(
+                    themer,
+                    'missing_file' if themer.get_theme(theme) is not None
+                    else 'unknown_theme'
+                )
+            raise TemplateNotFound(template)
+
+        try:
+            return themer.get_theme(owner).jinja_loader.get_source(
                 environment,
                 path
             )
+        except TemplateNotFound:
+            _record_miss(themer, 'missing_file')
+            raise
+
+
+def _record_miss(themer: Themer, reason: str):
+    if themer.metrics is not None:
+        themer.metrics.inc('themer_template_misses_total', reason=reason)
 
-        raise TemplateNotFound(template)
+
+class _DirectDispatchLoader(BaseLoader):
+    """
+    Sits in front of the app's own Jinja loader when `THEMER_DIRECT_DISPATCH`
+    is enabled, sending themed template paths straight to the
+    `_ThemeTemplateLoader` instead of having Flask try the app and every
+    blueprint's template folder first. Any other path is passed through
+    untouched.
+
+    If `module_loader` is given (by setting `THEMER_PRECOMPILED_DIR`), themed
+    templates are only ever loaded from the modules written by
+    `flask themer compile`, and are never parsed from source.
+    """
+    def __init__(self, loader: BaseLoader,
+                 module_loader: Optional[ModuleLoader] = None):
+        #: The loader this one replaced, usually Flask's
+        #: `DispatchingJinjaLoader`.
+        self.loader = loader
+        self.theme_loader = _ThemeTemplateLoader()
+        self.module_loader = module_loader
+
+    def get_source(self, environment, template):
+        if template.startswith(MAGIC_PATH_PREFIX):
+            return self.theme_loader.get_source(environment, template)
+        return self.loader.get_source(environment, template)
+
+    def load(self, environment, name, globals=None):
+        if self.module_loader is not None and \
+                name.startswith(MAGIC_PATH_PREFIX):
+            return self.module_loader.load(environment, name, globals)
+        return super().load(environment, name, globals)
+
+    def list_templates(self):
+        return self.loader.list_templates()
 
 
 theme_blueprint = Blueprint(
@@ -250,13 +2473,440 @@ theme_blueprint = Blueprint(
 setattr(theme_blueprint, 'jinja_loader', _ThemeTemplateLoader())
 
 
+class ThemeWatcher:
+    """Watches the directories of every `FileSystemThemeLoader` used by the
+    Themer on `app` for changes, keeping `Themer.themes` in sync and
+    invalidating the caches of just the themes that changed.
+
+    Changes are found by polling every `interval` seconds from a background
+    thread once `start()` is called, or by calling `poll()` directly.
+    Directories are only listed again when their mtime changes, and only
+    themes from lazy loaders that are currently loaded are checked.
+
+    `backend` can be `'watchdog'` to only poll after the OS has reported a
+    change (requires the `watchdog` package), or `'poll'` to always poll.
+    By default `'watchdog'` is used when it's installed.
+
+    With a watcher running, Jinja's `auto_reload` can be disabled in
+    production while still picking up changes to themes.
+    """
+    def __init__(self, app, interval: float = 1.0,
+                 backend: Optional[str] = None):
+        if backend is None:
+            backend = 'poll' if Observer is None else 'watchdog'
+        if backend not in ('poll', 'watchdog'):
+            raise ValueError(f'Unknown watcher backend {backend!r}.')
+        if backend == 'watchdog' and Observer is None:
+            raise ThemeError(
+                'The watchdog backend requires the watchdog package.'
+            )
+
+        self.app = app
+        self.interval = interval
+        #: The backend being used, either `'poll'` or `'watchdog'`.
+        self.backend = backend
+        self._stop = threading.Event()
+        self._changed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._observer = None
+        #: Maps directories to their (mtime, sub-directories, files) the last
+        #: time they were listed.
+        self._listings: Dict[str, Tuple[int, List[str], List[str]]] = {}
+        self._snapshot = self._scan()
+
+    def _scan(self) -> Dict[Tuple[int, str], str]:
+        """Returns a signature of every file in every theme, keyed by the
+        loader and theme name."""
+        snapshot = {}
+        listings: Dict[str, Tuple[int, List[str], List[str]]] = {}
+        themer = self.app.extensions[EXTENSION_KEY]
+        with themer._lazy_themes_lock:
+            loaded = list(themer._lazy_themes.values())
+
+        for i, loader in enumerate(themer.loaders):
+            if not isinstance(loader, FileSystemThemeLoader):
+                continue
+
+            # Lazy loaders can have any number of themes, and the ones that
+            # aren't loaded have nothing cached to invalidate.
+            themes = loader.themes if not loader.lazy else [
+                t for t in loaded if t.theme_loader is loader
+            ]
+            for theme in themes:
+                snapshot[(i, theme.name)] = self._signature(
+                    str(loader.path / theme.name),
+                    listings
+                )
+
+        self._listings = listings
+        return snapshot
+
+    def _signature(self, path: str, listings) -> str:
+        """Returns a signature of every file under `path`, only listing the
+        directories that changed since the last scan."""
+        signature = hashlib.sha1()
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+                listing = self._listings.get(directory)
+                if listing is None or listing[0] != mtime:
+                    dirs, files = [], []
+                    with os.scandir(directory) as it:
+                        for entry in it:
+                            if entry.is_dir(follow_symlinks=False):
+                                dirs.append(entry.name)
+                            else:
+                                files.append(entry.name)
+                    listing = (mtime, sorted(dirs), sorted(files))
+            except OSError:
+                continue
+
+            listings[directory] = listing
+            for filename in listing[2]:
+                file_path = os.path.join(directory, filename)
+                try:
+                    st = os.stat(file_path)
+                except OSError:
+                    continue
+                signature.update(
+                    f'{file_path}:{st.st_mtime_ns}:{st.st_size}\n'
+                    .encode('utf-8', 'surrogateescape')
+                )
+
+            pending.extend(
+                os.path.join(directory, d) for d in reversed(listing[1])
+            )
+
+        return signature.hexdigest()
+
+    def poll(self) -> List[str]:
+        """Check for changes once, returning the names of any themes that
+        were added, removed or changed."""
+        self._changed.clear()
+        snapshot = self._scan()
+        themer = self.app.extensions[EXTENSION_KEY]
+        # Themes from lazy loaders come and go as they're used, which isn't
+        # a change to the theme itself.
+        changed = sorted({
+            name for i, name in snapshot.keys() ^ self._snapshot.keys()
+            if not themer.loaders[i].lazy
+        } | {
+            key[1] for key in snapshot.keys() & self._snapshot.keys()
+            if snapshot[key] != self._snapshot[key]
+        })
+        self._snapshot = snapshot
+
+        if changed:
+            with self.app.app_context():
+                themer = _current_themer()
+                themer.refresh()
+                for name in changed:
+                    themer.invalidate(name)
+
+        return changed
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self._observer is not None and not self._changed.is_set():
+                continue
+
+            try:
+                self.poll()
+            except Exception:
+                # Try again next time, even if nothing else changes.
+                self._changed.set()
+                self.app.logger.exception(
+                    'Failed to check themes for changes.'
+                )
+
+    def start(self):
+        """Start watching for changes in a background thread."""
+        self._stop.clear()
+
+        if self.backend == 'watchdog':
+            self._observer = Observer()
+            handler = _WatchdogHandler(self._changed)
+            themer = self.app.extensions[EXTENSION_KEY]
+            for loader in themer.loaders:
+                if isinstance(loader, FileSystemThemeLoader) and \
+                        loader.path.is_dir():
+                    self._observer.schedule(
+                        handler,
+                        str(loader.path),
+                        recursive=True
+                    )
+            self._observer.start()
+            # Anything that changed before the observer started would
+            # otherwise be missed.
+            self._changed.set()
+
+        self._thread = threading.Thread(
+            target=self._run,
+            name='flask-themer-watcher',
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching for changes, waiting for the background thread to
+        exit."""
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class _WatchdogHandler:
+    """Receives events from a watchdog `Observer`, flagging that something
+    changed."""
+    #: Events that don't change anything, such as a static asset being read.
+    IGNORED_EVENTS = ('opened', 'closed_no_write')
+
+    def __init__(self, changed: threading.Event):
+        self.changed = changed
+
+    def dispatch(self, event):
+        if event.event_type not in self.IGNORED_EVENTS:
+            self.changed.set()
+
+
+themer_cli = AppGroup('themer', help='Manage Flask-Themer themes.')
+
+
+@themer_cli.command('compress')
+@click.option(
+    '--jobs', '-j',
+    type=click.IntRange(min=1),
+    default=None,
+    help='Number of processes to use. Defaults to the number of CPUs.'
+)
+@click.option(
+    '--force', '-f',
+    is_flag=True,
+    help='Recompress files even if their compressed copies are up to date.'
+)
+def compress_command(jobs, force):
+    """Write precompressed copies of every theme's static assets."""
+    themer = _current_themer()
+
+    paths = []
+    for theme in themer.iter_themes():
+        if isinstance(theme.theme_loader, FileSystemThemeLoader):
+            paths.extend(theme.theme_loader.iter_static_files(theme.name))
+
+    forces = [force] * len(paths)
+    if jobs == 1:
+        results = list(map(compress_static_file, paths, forces))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(compress_static_file, paths, forces))
+
+    count = 0
+    for written in results:
+        for sidecar, original, compressed in written:
+            count += 1
+            click.echo(f'{sidecar} ({original} -> {compressed} bytes)')
+
+    click.echo(f'Wrote {count} compressed files for {len(paths)} assets.')
+
+
+@themer_cli.command('compile')
+@click.argument('target', type=click.Path(file_okay=False))
+@click.option(
+    '--extension', '-e', 'extensions',
+    multiple=True,
+    help=(
+        'Only compile templates with this extension. Can be given more than '
+        'once.'
+    )
+)
+def compile_command(target, extensions):
+    """Compile every theme's templates ahead of time into TARGET.
+
+    Set THEMER_PRECOMPILED_DIR to TARGET to use the compiled templates
+    instead of the template sources. Static assets are never compiled.
+    """
+    themer = _current_themer()
+    environment = current_app.jinja_env
+    extensions = tuple(f'.{e.lstrip(".")}' for e in extensions)
+
+    os.makedirs(target, exist_ok=True)
+
+    compiled = 0
+    failed = 0
+    for theme in themer.iter_themes():
+        try:
+            paths = theme.jinja_loader.list_templates()
+        except TypeError:
+            click.echo(
+                f'Skipping {theme.name}, its loader can\'t list templates.',
+                err=True
+            )
+            continue
+
+        for path in paths:
+            if path.startswith('static/'):
+                continue
+
+            if extensions and not path.endswith(extensions):
+                continue
+
+            name = f'{MAGIC_PATH_PREFIX}/{theme.name}/{path}'
+            try:
+                source, filename, _ = theme.jinja_loader.get_source(
+                    environment,
+                    path
+                )
+                code = environment.compile(
+                    source,
+                    name,
+                    filename,
+                    raw=True,
+                    defer_init=True
+                )
+            except (TemplateSyntaxError, UnicodeDecodeError) as e:
+                failed += 1
+                click.echo(f'Could not compile {name}: {e}', err=True)
+                continue
+
+            module_path = os.path.join(
+                target,
+                ModuleLoader.get_module_filename(name)
+            )
+            with open(module_path, 'w', encoding='utf-8') as fout:
+                fout.write(code)
+
+            compiled += 1
+
+    click.echo(f'Compiled {compiled} templates into {target}.')
+
+    if failed:
+        raise click.ClickException(f'{failed} templates failed to compile.')
+
+
 @theme_blueprint.route('/_theme/<theme>/<path:filename>', endpoint='static')
 def serve_static(theme, filename):
     themer = _current_themer()
+    if themer.metrics is None:
+        return _serve_static(themer, theme, filename)
 
+    started = time.perf_counter()
+    # The theme comes straight from the URL, so requests for themes that
+    # don't exist share a single label instead of creating a new series
+    # for every name a client makes up.
+    label = theme if themer.get_theme(theme) is not None else 'unknown'
+    response = None
+    status = 500
     try:
-        t = themer.themes[theme]
-    except KeyError:
+        response = _serve_static(themer, theme, filename)
+        status = response.status_code
+        return response
+    except HTTPException as e:
+        status = e.code
+        raise
+    finally:
+        themer.metrics.inc(
+            'themer_static_responses_total',
+            theme=label,
+            status=status
+        )
+        themer.metrics.inc(
+            'themer_static_bytes_total',
+            response.content_length or 0 if response is not None else 0,
+            theme=label
+        )
+        themer.metrics.observe(
+            'themer_static_seconds',
+            time.perf_counter() - started,
+            theme=label
+        )
+
+
+def _serve_static(themer, theme, filename):
+    t = themer.get_theme(theme)
+    if t is None:
         abort(404)
 
-    return t.theme_loader.get_static(theme, filename)
+    cache = themer.static_cache
+    cached = None
+    if cache is not None:
+        # The response may depend on which precompressed copies the client
+        # can accept, so those are part of the key.
+        key = (theme, filename, tuple(
+            encoding for encoding, _ in PRECOMPRESSED_ENCODINGS
+            if request.accept_encodings.quality(encoding)
+        ))
+        cached = cache.get(key)
+
+        if themer.metrics is not None:
+            themer.metrics.inc(
+                'themer_static_cache_requests_total',
+                result='miss' if cached is None else 'hit'
+            )
+
+    if cached is not None:
+        digest = cached.digest
+    else:
+        digest = t.theme_loader.get_static_digest(theme, filename)
+
+    response = None
+    if digest and request.if_none_match:
+        # Answer revalidations without ever asking the loader for the asset.
+        for etag in _static_etags(digest):
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+                response.set_etag(etag)
+                break
+
+    if response is None and cached is not None:
+        response = current_app.response_class(
+            cached.body,
+            status=cached.status,
+            headers=cached.headers
+        )
+    elif response is None:
+        response = make_response(t.theme_loader.get_static(theme, filename))
+        if digest and response.status_code == 200:
+            if response.content_encoding:
+                response.set_etag(f'{digest}-{response.content_encoding}')
+            else:
+                response.set_etag(digest)
+
+        if cache is not None:
+            cache.store(key, response, digest)
+
+    fingerprint = request.args.get(FINGERPRINT_ARG)
+    if fingerprint and digest and response.status_code in (200, 304) and \
+            current_app.config[f'{CONFIG_PREFIX}STATIC_FINGERPRINT']:
+        # Only promise the asset will never change if the URL was for the
+        # version we're actually sending.
+        if digest[:FINGERPRINT_LENGTH] == fingerprint:
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = FINGERPRINT_MAX_AGE
+            response.cache_control.immutable = True
+
+    return response
+
+
+def metrics_view():
+    """Serve the metrics recorded by the current Themer in the Prometheus
+    text format."""
+    return current_app.response_class(
+        _current_themer().metrics.to_prometheus(),
+        mimetype='text/plain; version=0.0.4'
+    )
+
+
+def _static_etags(digest: str) -> List[str]:
+    """Returns every strong ETag a static asset with the given digest may
+    have been served with, one for each possible content encoding."""
+    return [digest] + [
+        f'{digest}-{encoding}' for encoding, _ in PRECOMPRESSED_ENCODINGS
+    ]
@@ -14,11 +14,17 @@ setup(
     long_description_content_type='text/markdown',
     py_modules=['flask_themer'],
     install_requires=[
-        'flask'
+        'flask>=2.2'
     ],
+    extras_require={
+        'brotli': ['brotli'],
+        'watch': ['watchdog']
+    },
     tests_require=[
         'pytest',
-        'pytest-cov'
+        'pytest-cov',
+        'brotli',
+        'watchdog'
     ],
     classifiers=[
         'Programming Language :: Python :: 3',
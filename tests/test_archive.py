@@ -0,0 +1,190 @@
+import hashlib
+import threading
+import zipfile
+from wsgiref.validate import validator
+
+import pytest
+from flask import Flask
+from werkzeug.test import EnvironBuilder
+from jinja2 import TemplateNotFound
+
+from flask_themer import (
+    Themer,
+    ArchiveThemeLoader,
+    ArchiveTemplateLoader,
+    _MemoryFile,
+    render_template,
+    lookup_static_theme_path
+)
+
+
+@pytest.fixture
+def archive_path(tmp_path):
+    path = tmp_path / 'themes.zip'
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('README.txt', 'Not a theme.')
+        archive.writestr('first/', '')
+        archive.writestr(
+            'first/test.html',
+            'Hello from {{ name }}.',
+            compress_type=zipfile.ZIP_DEFLATED
+        )
+        archive.writestr(
+            'first/sub/stored.html',
+            'Stored.',
+            compress_type=zipfile.ZIP_STORED
+        )
+        archive.writestr(
+            'first/bzip.html',
+            'Compressed with bzip2.',
+            compress_type=zipfile.ZIP_BZIP2
+        )
+        archive.writestr(
+            'first/static/site.css',
+            'body { color: red; }',
+            compress_type=zipfile.ZIP_STORED
+        )
+        archive.writestr(
+            'first/static/packed.bin',
+            b'\x00' * 1000,
+            compress_type=zipfile.ZIP_DEFLATED
+        )
+        archive.writestr('second/test.html', 'Second theme.')
+        archive.writestr('_hidden/test.html', 'Hidden theme.')
+    return path
+
+
+@pytest.fixture
+def app(archive_path):
+    app = Flask('testing')
+    app.config['SERVER_NAME'] = 'testing'
+
+    themer = Themer(app, loaders=[
+        ArchiveThemeLoader(
+            archive_path,
+            filter=lambda name: not name.startswith('_')
+        )
+    ])
+    themer.current_theme_loader(lambda: 'first')
+
+    with app.app_context():
+        yield app
+
+
+def test_themes(app):
+    """Ensure every top-level directory in the archive is a theme."""
+    themer = app.extensions['themer']
+    assert sorted(themer.themes) == ['first', 'second']
+
+    loader = themer.themes['first'].jinja_loader
+    assert isinstance(loader, ArchiveTemplateLoader)
+    assert loader.list_templates() == [
+        'bzip.html',
+        'static/packed.bin',
+        'static/site.css',
+        'sub/stored.html',
+        'test.html'
+    ]
+
+
+def test_templates(app, archive_path):
+    """Ensure templates can be read regardless of how they're stored."""
+    assert render_template('test.html', name='a zip') == 'Hello from a zip.'
+    assert render_template('sub/stored.html') == 'Stored.'
+    assert render_template('bzip.html') == 'Compressed with bzip2.'
+
+    loader = app.extensions['themer'].themes['first'].jinja_loader
+    source, filename, uptodate = loader.get_source(
+        app.jinja_env,
+        'sub/stored.html'
+    )
+    assert filename == f'{archive_path}/first/sub/stored.html'
+    assert uptodate is None
+
+    with pytest.raises(TemplateNotFound):
+        loader.get_source(app.jinja_env, 'missing.html')
+
+    with pytest.raises(TemplateNotFound):
+        loader.get_source(app.jinja_env, '../second/test.html')
+
+
+def test_static(app):
+    """Ensure static assets can be served from the archive."""
+    with app.test_client() as client:
+        rv = client.get(lookup_static_theme_path('site.css'))
+        assert rv.status_code == 200
+        assert rv.mimetype == 'text/css'
+        assert rv.content_length == 20
+        assert rv.data == b'body { color: red; }'
+        assert rv.get_etag() == (
+            hashlib.sha256(b'body { color: red; }').hexdigest(),
+            False
+        )
+
+        rv = client.get(lookup_static_theme_path('packed.bin'))
+        assert rv.mimetype == 'application/octet-stream'
+        assert rv.data == b'\x00' * 1000
+
+        rv = client.get(lookup_static_theme_path('missing.css'))
+        assert rv.status_code == 404
+
+
+def test_static_wsgi(app):
+    """Ensure static assets are sent as bytes, as WSGI requires."""
+    wsgi_app = validator(app.wsgi_app)
+    started = []
+
+    for path in ('site.css', 'packed.bin'):
+        environ = EnvironBuilder(
+            lookup_static_theme_path(path)
+        ).get_environ()
+        body = wsgi_app(environ, lambda *args: started.append(args))
+        try:
+            chunks = list(body)
+        finally:
+            body.close()
+
+        assert all(type(chunk) is bytes for chunk in chunks)
+        assert started.pop()[0] == '200 OK'
+
+    assert b''.join(chunks) == b'\x00' * 1000
+
+    stored = _MemoryFile(memoryview(b'stored'))
+    assert stored.readable()
+    assert stored.read(4) == b'stor'
+    assert stored.read() == b'ed'
+
+
+def test_static_digest(app):
+    """Ensure digests are computed once and remembered."""
+    loader = app.extensions['themer'].themes['first'].theme_loader
+
+    digest = loader.get_static_digest('first', 'site.css')
+    assert digest == hashlib.sha256(b'body { color: red; }').hexdigest()
+    assert loader._digests[('first', 'site.css')] == digest
+    assert loader.get_static_digest('first', 'site.css') == digest
+
+    assert loader.get_static_digest('first', 'missing.css') is None
+    assert loader.get_static_digest('missing', 'site.css') is None
+
+
+def test_threaded_reads(app):
+    """Ensure the archive can be read from many threads at once."""
+    loader = app.extensions['themer'].themes['first'].jinja_loader
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(100):
+                for name in ('test.html', 'sub/stored.html', 'bzip.html'):
+                    loader.get_source(app.jinja_env, name)
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
@@ -0,0 +1,164 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+from flask import Flask, template_rendered
+from jinja2 import TemplateNotFound
+
+from flask_themer import (
+    Themer,
+    FileSystemThemeLoader,
+    ThemeError,
+    NoThemeResolver,
+    MAGIC_PATH_PREFIX,
+    render_template,
+    render_template_async,
+    use_theme
+)
+
+
+@pytest.fixture
+def app(tmp_path):
+    (tmp_path / 'async_theme').mkdir()
+    (tmp_path / 'async_theme' / 'static.html').write_text(
+        '{{ theme_static("site.css") }}'
+    )
+    (tmp_path / 'async_theme' / 'hello.html').write_text('Hello {{ name }}!')
+
+    app = Flask(
+        'testing',
+        template_folder=Path('tests') / 'data' / 'templates'
+    )
+    app.config['SERVER_NAME'] = 'testing'
+
+    Themer(app, loaders=[
+        FileSystemThemeLoader(Path('tests') / 'data'),
+        FileSystemThemeLoader(tmp_path)
+    ])
+
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def resolved(app):
+    """Use a coroutine function as the theme resolver, recording each call."""
+    calls = []
+
+    @app.extensions['themer'].current_theme_loader
+    async def get_current_theme():
+        await asyncio.sleep(0)
+        calls.append(None)
+        return 'test_theme'
+
+    return calls
+
+
+def test_render(app, resolved):
+    """Ensure templates are rendered from the theme, and fall back to the
+    app's own templates."""
+    async def render():
+        return (
+            await render_template_async('test.html'),
+            await render_template_async('fallback.html'),
+            await render_template_async('inheritance.html')
+        )
+
+    assert asyncio.run(render()) == (
+        'This is a test.',
+        'This is a fallback template.',
+        'This is rendered in other_test_theme.'
+    )
+    assert len(resolved) == 1
+
+
+def test_render_context(app):
+    """Ensure the context is passed to the template, and signals are
+    sent."""
+    rendered = []
+    app.extensions['themer'].current_theme_loader(lambda: 'async_theme')
+
+    def record(sender, template, context, **extra):
+        rendered.append((template.name, context['name']))
+
+    template_rendered.connect(record, app)
+    try:
+        assert asyncio.run(render_template_async(
+            'hello.html',
+            name='world'
+        )) == 'Hello world!'
+    finally:
+        template_rendered.disconnect(record, app)
+
+    assert rendered == [
+        (f'{MAGIC_PATH_PREFIX}/async_theme/hello.html', 'world')
+    ]
+
+
+def test_resolved_theme_used_by_globals(app):
+    """Ensure template globals use the theme resolved for the render, even
+    though they can't await the resolver."""
+    @app.extensions['themer'].current_theme_loader
+    async def get_current_theme():
+        return 'async_theme'
+
+    assert asyncio.run(render_template_async('static.html')) == \
+        'http://testing/_theme/async_theme/site.css'
+
+
+def test_missing_include(app, resolved):
+    """Ensure a missing template included from a themed template falls back,
+    just like render_template."""
+    with pytest.raises(TemplateNotFound):
+        asyncio.run(render_template_async('use_fallback.html'))
+
+
+def test_sync_resolver(app):
+    """Ensure plain resolvers work with render_template_async."""
+    app.config['THEMER_CACHE_CURRENT_THEME'] = False
+    app.extensions['themer'].current_theme_loader(lambda: 'test_theme')
+
+    assert asyncio.run(render_template_async('test.html')) == \
+        'This is a test.'
+
+
+def test_explicit_theme(app, resolved):
+    """Ensure use_theme takes precedence over the resolver."""
+    async def render():
+        with use_theme('other_test_theme'):
+            return await render_template_async('inheritance.html')
+
+    assert asyncio.run(render()) == 'This is rendered in other_test_theme.'
+    assert not resolved
+
+
+def test_async_resolver_from_sync(app, resolved):
+    """Ensure resolving an async resolver's theme outside of a coroutine
+    fails clearly."""
+    with pytest.raises(ThemeError, match='asynchronous'):
+        render_template('test.html')
+
+
+def test_no_resolver(app):
+    """Ensure we raise an error when no resolver is registered."""
+    with pytest.raises(NoThemeResolver):
+        asyncio.run(render_template_async('test.html'))
+
+
+def test_separate_cache(app, resolved):
+    """Ensure async templates are cached apart from the app's own, and are
+    dropped by invalidate."""
+    themer = app.extensions['themer']
+    asyncio.run(render_template_async('test.html'))
+
+    name = f'{MAGIC_PATH_PREFIX}/test_theme/test.html'
+    env = themer._async_env
+    assert env.is_async and not app.jinja_env.is_async
+    assert [key[1] for key in env.cache.keys()] == [name]
+    assert not list(app.jinja_env.cache.keys())
+
+    themer.invalidate('test_theme')
+    assert not list(env.cache.keys())
+
+    app.jinja_env.cache = None
+    themer.invalidate()
@@ -0,0 +1,135 @@
+import os
+from pathlib import Path
+
+import pytest
+from flask import Flask
+
+from flask_themer import (
+    Themer,
+    FileSystemThemeLoader,
+    ThemeBytecodeCache,
+    MAGIC_PATH_PREFIX,
+    render_template
+)
+
+
+def make_app(cache_dir):
+    app = Flask(
+        'testing',
+        template_folder=Path('tests') / 'data' / 'templates'
+    )
+    app.config['THEMER_BYTECODE_CACHE_DIR'] = cache_dir
+
+    themer = Themer(app, loaders=[
+        FileSystemThemeLoader(Path('tests') / 'data')
+    ])
+    themer.current_theme_loader(lambda: 'test_theme')
+    return app
+
+
+def test_cache(tmp_path, monkeypatch):
+    """Ensure compiled templates are stored per theme and reused by other
+    apps sharing the same directory."""
+    app = make_app(tmp_path)
+    assert isinstance(app.jinja_env.bytecode_cache, ThemeBytecodeCache)
+
+    with app.app_context():
+        assert render_template('test.html') == 'This is a test.'
+        assert render_template('fallback.html') == (
+            'This is a fallback template.'
+        )
+
+    assert len(list((tmp_path / 'theme-test_theme').glob('*.cache'))) == 1
+    assert len(list((tmp_path / '_app').glob('*.cache'))) == 1
+    assert not list(tmp_path.glob('*/*.tmp'))
+
+    # A second app (or worker) sharing the directory never compiles.
+    app = make_app(tmp_path)
+
+    def compile(*args, **kwargs):
+        raise AssertionError('Template was compiled.')
+
+    monkeypatch.setattr(app.jinja_env, 'compile', compile)
+
+    with app.app_context():
+        assert render_template('test.html') == 'This is a test.'
+
+
+def test_changed_template(tmp_path):
+    """Ensure a changed template replaces its entry instead of adding one
+    for every version."""
+    theme = tmp_path / 'themes' / 'a'
+    theme.mkdir(parents=True)
+
+    app = Flask('testing')
+    app.config['THEMER_BYTECODE_CACHE_DIR'] = tmp_path / 'cache'
+    app.jinja_env.auto_reload = True
+    themer = Themer(app, loaders=[FileSystemThemeLoader(theme.parent)])
+    themer.current_theme_loader(lambda: 'a')
+
+    for version in range(5):
+        (theme / 'page.html').write_text(f'Version {version}')
+        mtime = version + 1
+        os.utime(theme / 'page.html', (mtime, mtime))
+        with app.app_context():
+            assert render_template('page.html') == f'Version {version}'
+
+    assert len(list((tmp_path / 'cache' / 'theme-a').glob('*.cache'))) == 1
+
+    # A fresh app ignores the entry if the template changed since.
+    (theme / 'page.html').write_text('Changed')
+    app = Flask('testing')
+    app.config['THEMER_BYTECODE_CACHE_DIR'] = tmp_path / 'cache'
+    themer = Themer(app, loaders=[FileSystemThemeLoader(theme.parent)])
+    themer.current_theme_loader(lambda: 'a')
+    with app.app_context():
+        assert render_template('page.html') == 'Changed'
+
+
+def test_prune(tmp_path):
+    """Ensure a single theme's entries can be removed."""
+    app = make_app(tmp_path)
+    themer = app.extensions['themer']
+
+    with app.app_context():
+        render_template('test.html')
+        render_template('inheritance.html')
+
+        assert (tmp_path / 'theme-test_theme').exists()
+        assert (tmp_path / 'theme-other_test_theme').exists()
+
+        themer.invalidate('test_theme')
+        assert not (tmp_path / 'theme-test_theme').exists()
+        assert (tmp_path / 'theme-other_test_theme').exists()
+
+        themer.invalidate()
+        assert not tmp_path.exists()
+
+
+def test_theme_directory(tmp_path):
+    """Ensure theme names are safe to use as directory names."""
+    cache = ThemeBytecodeCache(tmp_path)
+    assert cache._theme_directory(f'{MAGIC_PATH_PREFIX}/a b/c/d.html') == (
+        tmp_path / 'theme-a%20b'
+    )
+    assert cache._theme_directory(f'{MAGIC_PATH_PREFIX}/../x.html') == (
+        tmp_path / 'theme-..'
+    )
+    assert cache._theme_directory('a.html') == tmp_path / '_app'
+
+
+def test_failed_write(tmp_path):
+    """Ensure partially written entries are cleaned up."""
+    cache = ThemeBytecodeCache(tmp_path)
+
+    class Bucket:
+        key = str(tmp_path / 'theme-a' / 'entry.cache')
+
+        def write_bytecode(self, f):
+            f.write(b'partial')
+            raise ValueError
+
+    with pytest.raises(ValueError):
+        cache.dump_bytecode(Bucket())
+
+    assert list((tmp_path / 'theme-a').iterdir()) == []
@@ -0,0 +1,207 @@
+import asyncio
+import gzip
+import os
+from pathlib import Path
+
+import brotli
+import pytest
+from flask import Flask
+from jinja2.loaders import BaseLoader
+
+import flask_themer
+from flask_themer import (
+    Themer,
+    Theme,
+    ThemeLoader,
+    FileSystemThemeLoader,
+    compress_static_file,
+    render_template,
+    render_template_async
+)
+
+
+@pytest.fixture
+def theme_dir(tmp_path):
+    static = tmp_path / 'themes' / 'test_theme' / 'static'
+    (static / 'css').mkdir(parents=True)
+    (static / 'css' / 'site.css').write_text('body { color: red; }\n' * 100)
+    (static / 'tiny.txt').write_text('a')
+    return tmp_path / 'themes'
+
+
+@pytest.fixture
+def app(theme_dir):
+    app = Flask('testing')
+    Themer(app, loaders=[FileSystemThemeLoader(theme_dir)])
+    return app
+
+
+def test_compress_static_file(theme_dir, monkeypatch):
+    """Ensure compressed copies are written only when they're useful."""
+    path = str(theme_dir / 'test_theme' / 'static' / 'css' / 'site.css')
+    original = Path(path).read_bytes()
+
+    written = compress_static_file(path)
+    assert [w[0] for w in written] == [path + '.br', path + '.gz']
+    assert brotli.decompress(Path(path + '.br').read_bytes()) == original
+    assert gzip.decompress(Path(path + '.gz').read_bytes()) == original
+
+    # Up to date copies are skipped unless forced.
+    assert compress_static_file(path) == []
+    assert len(compress_static_file(path, force=True)) == 2
+
+    # Stale copies are replaced.
+    os.utime(path + '.gz', (0, 0))
+    assert [w[0] for w in compress_static_file(path)] == [path + '.gz']
+
+    # Copies that wouldn't be any smaller aren't written.
+    tiny = str(theme_dir / 'test_theme' / 'static' / 'tiny.txt')
+    assert compress_static_file(tiny) == []
+    assert not os.path.exists(tiny + '.gz')
+
+    # ...and an out of date copy is removed rather than left behind.
+    Path(tiny + '.gz').write_bytes(b'stale')
+    os.utime(tiny + '.gz', (0, 0))
+    assert compress_static_file(tiny) == []
+    assert not os.path.exists(tiny + '.gz')
+
+    # Copies are written through temporary files, which are cleaned up.
+    assert sorted(os.listdir(os.path.dirname(path))) == [
+        'site.css', 'site.css.br', 'site.css.gz'
+    ]
+
+    def fail(src, dst):
+        raise OSError('Failed to replace.')
+
+    monkeypatch.setattr(os, 'replace', fail)
+    with pytest.raises(OSError):
+        compress_static_file(path, force=True)
+    monkeypatch.undo()
+    assert sorted(os.listdir(os.path.dirname(path))) == [
+        'site.css', 'site.css.br', 'site.css.gz'
+    ]
+
+    # Brotli is optional.
+    monkeypatch.setattr(flask_themer, 'brotli', None)
+    os.remove(path + '.br')
+    assert len(compress_static_file(path, force=True)) == 1
+    assert not os.path.exists(path + '.br')
+
+
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_compress_command(app, theme_dir, jobs):
+    """Ensure the compress command compresses every theme's static assets."""
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(args=['themer', 'compress', '--jobs', jobs])
+    assert result.exit_code == 0, result.output
+    assert 'Wrote 2 compressed files for 2 assets.' in result.output
+
+    css = theme_dir / 'test_theme' / 'static' / 'css' / 'site.css'
+    assert (css.parent / 'site.css.gz').exists()
+    assert (css.parent / 'site.css.br').exists()
+
+    # Compressed copies are never compressed themselves.
+    result = runner.invoke(args=['themer', 'compress', '--jobs', jobs])
+    assert 'Wrote 0 compressed files for 2 assets.' in result.output
+
+
+class UnlistableLoader(BaseLoader):
+    pass
+
+
+class UnlistableThemeLoader(ThemeLoader):
+    @property
+    def themes(self):
+        yield Theme(
+            name='unlistable',
+            theme_loader=self,
+            jinja_loader=UnlistableLoader()
+        )
+
+
+def make_app(**config):
+    app = Flask(
+        'testing',
+        template_folder=Path('tests') / 'data' / 'templates'
+    )
+    app.config.update(config)
+    themer = Themer(app, loaders=[
+        FileSystemThemeLoader(Path('tests') / 'data'),
+        UnlistableThemeLoader()
+    ])
+    themer.current_theme_loader(lambda: 'test_theme')
+    return app
+
+
+def test_compile_command(tmp_path, monkeypatch):
+    """Ensure every theme's templates can be compiled ahead of time and
+    used without ever being parsed."""
+    target = tmp_path / 'compiled'
+    runner = make_app().test_cli_runner()
+
+    result = runner.invoke(args=['themer', 'compile', str(target)])
+    assert result.exit_code == 0, result.output
+    assert 'Compiled 6 templates' in result.output
+    assert 'Skipping unlistable' in result.output
+    assert len(list(target.glob('tmpl_*.py'))) == 6
+
+    app = make_app(THEMER_PRECOMPILED_DIR=str(target))
+
+    def compile(*args, **kwargs):
+        raise AssertionError('Template was compiled.')
+
+    with app.app_context():
+        # The app's own templates are still compiled as usual.
+        assert render_template('fallback.html') == (
+            'This is a fallback template.'
+        )
+
+        # Compiled modules can't be run in async mode, so async renders
+        # still compile from source.
+        assert asyncio.run(render_template_async('test.html')) == \
+            'This is a test.'
+        assert asyncio.run(render_template_async('inheritance.html')) == \
+            'This is rendered in other_test_theme.'
+
+        monkeypatch.setattr(app.jinja_env, 'compile', compile)
+
+        assert render_template('test.html') == 'This is a test.'
+        assert render_template('inheritance.html') == (
+            'This is rendered in other_test_theme.'
+        )
+        assert render_template('fallback.html') == (
+            'This is a fallback template.'
+        )
+
+
+def test_compile_command_extensions(tmp_path):
+    """Ensure only templates with the given extensions are compiled."""
+    runner = make_app().test_cli_runner()
+
+    result = runner.invoke(args=[
+        'themer', 'compile', str(tmp_path), '-e', 'txt', '-e', '.xml'
+    ])
+    assert result.exit_code == 0, result.output
+    assert 'Compiled 0 templates' in result.output
+
+
+def test_compile_command_errors(tmp_path):
+    """Ensure templates that can't be compiled are reported and fail the
+    command."""
+    theme = tmp_path / 'themes' / 'broken'
+    theme.mkdir(parents=True)
+    (theme / 'syntax.html').write_text('{% if %}')
+    (theme / 'binary.html').write_bytes(b'\xff\xfe')
+    (theme / 'fine.html').write_text('Fine.')
+
+    app = Flask('testing')
+    Themer(app, loaders=[FileSystemThemeLoader(tmp_path / 'themes')])
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(args=['themer', 'compile', str(tmp_path / 'out')])
+    assert result.exit_code == 1
+    assert 'Compiled 1 templates' in result.output
+    assert 'Could not compile ☃/broken/syntax.html' in result.output
+    assert 'Could not compile ☃/broken/binary.html' in result.output
+    assert '2 templates failed to compile.' in result.output
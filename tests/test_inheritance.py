@@ -0,0 +1,206 @@
+import pytest
+from flask import Flask
+from jinja2 import DictLoader
+
+from flask_themer import (
+    Themer,
+    Theme,
+    ThemeLoader,
+    ThemeError,
+    FileSystemThemeLoader,
+    MAGIC_PATH_PREFIX,
+    render_template,
+    lookup_theme_path,
+    use_theme
+)
+
+
+class DictThemeLoader(ThemeLoader):
+    def __init__(self, themes, lazy=False):
+        self._themes = themes
+        self.lazy = lazy
+
+    @property
+    def themes(self):
+        for name, (parent, templates) in self._themes.items():
+            yield Theme(
+                name=name,
+                theme_loader=self,
+                jinja_loader=DictLoader(templates),
+                data={'parent': parent} if parent else {}
+            )
+
+
+@pytest.fixture
+def theme_dir(tmp_path):
+    themes = {
+        'base': {
+            'page.html': '{% extends theme("layout.html") %}'
+                         '{% block body %}Base page{% endblock %}',
+            'layout.html': 'Base layout: {% block body %}{% endblock %}',
+            'only_base.html': 'Only in base',
+        },
+        'middle': {
+            'layout.html': 'Middle layout: {% block body %}{% endblock %}',
+        },
+        'child': {
+            'page.html': '{% extends theme("layout.html") %}'
+                         '{% block body %}Child page{% endblock %}',
+        },
+    }
+    for theme, templates in themes.items():
+        (tmp_path / 'themes' / theme).mkdir(parents=True)
+        for name, source in templates.items():
+            (tmp_path / 'themes' / theme / name).write_text(source)
+
+    (tmp_path / 'templates').mkdir()
+    (tmp_path / 'templates' / 'app.html').write_text('From the app')
+    return tmp_path
+
+
+@pytest.fixture(params=[False, True], ids=['plain', 'indexed'])
+def app(theme_dir, request):
+    app = Flask('testing', template_folder=theme_dir / 'templates')
+    themer = Themer(app, loaders=[
+        FileSystemThemeLoader(
+            theme_dir / 'themes',
+            index=request.param,
+            parents={'child': 'middle', 'middle': 'base'}
+        )
+    ])
+    themer.current_theme_loader(lambda: 'child')
+
+    with app.app_context():
+        yield app
+
+
+def test_chain(app):
+    """Ensure templates are found by walking up the inheritance chain before
+    falling back to the app."""
+    themer = app.extensions['themer']
+
+    assert render_template('page.html') == 'Middle layout: Child page'
+    assert render_template('only_base.html') == 'Only in base'
+    assert render_template('app.html') == 'From the app'
+
+    assert themer._resolved['child'] == {
+        'page.html': 'child',
+        'layout.html': 'middle',
+        'only_base.html': 'base',
+        'app.html': None
+    }
+
+    # The parent's own lookups are independent of the child.
+    themer.current_theme_loader(lambda: 'middle')
+    assert render_template('page.html') == 'Middle layout: Base page'
+
+    themer.current_theme_loader(lambda: 'base')
+    assert render_template('page.html') == 'Base layout: Base page'
+
+
+def test_invalidate_parent(app, theme_dir):
+    """Ensure invalidating a theme also forgets lookups by the themes that
+    inherit from it."""
+    themer = app.extensions['themer']
+
+    assert render_template('only_base.html') == 'Only in base'
+    themer.current_theme_loader(lambda: 'middle')
+    assert render_template('only_base.html') == 'Only in base'
+    themer.current_theme_loader(lambda: 'base')
+    assert render_template('only_base.html') == 'Only in base'
+
+    (theme_dir / 'themes' / 'middle' / 'only_base.html').write_text('Middle')
+    themer.invalidate('middle')
+
+    assert sorted(themer._resolved) == ['base']
+
+    themer.current_theme_loader(lambda: 'child')
+    assert render_template('only_base.html') == 'Middle'
+
+
+def test_overlays_share_templates():
+    """Ensure overlay themes share the compiled templates they inherit, while
+    their own overrides still apply."""
+    app = Flask('testing')
+    themer = Themer(app, loaders=[DictThemeLoader({
+        'base': (None, {
+            'layout.html': '[{% include theme("part.html") %}]',
+            'part.html': 'Base part',
+        }),
+        'a': ('base', {'part.html': 'Overlay part'}),
+        'b': ('base', {}),
+    })])
+
+    with app.app_context():
+        assert lookup_theme_path('layout.html', theme='a') == \
+            f'{MAGIC_PATH_PREFIX}/base/layout.html'
+        assert lookup_theme_path('part.html', theme='a') == \
+            f'{MAGIC_PATH_PREFIX}/a/part.html'
+        assert lookup_theme_path('missing.html', theme='a') == \
+            f'{MAGIC_PATH_PREFIX}/a/missing.html'
+
+        for theme, expected in (
+            ('a', '[Overlay part]'),
+            ('b', '[Base part]'),
+            ('base', '[Base part]'),
+        ):
+            with use_theme(theme):
+                assert render_template('layout.html') == expected
+
+        assert sorted(key[1] for key in app.jinja_env.cache.keys()) == [
+            f'{MAGIC_PATH_PREFIX}/a/part.html',
+            f'{MAGIC_PATH_PREFIX}/base/layout.html',
+            f'{MAGIC_PATH_PREFIX}/base/part.html',
+        ]
+
+
+def test_missing_parent():
+    """Ensure a chain stops at a parent that doesn't exist."""
+    app = Flask('testing')
+    themer = Themer(app, loaders=[DictThemeLoader({
+        'orphan': ('missing', {'a.html': 'A'}),
+    })])
+
+    with app.app_context():
+        assert themer.resolve_template('orphan', 'a.html') == 'orphan'
+        assert themer.resolve_template('orphan', 'b.html') is None
+        assert themer.resolve_template('missing', 'a.html') is None
+        assert 'missing' not in themer._resolved
+
+
+def test_cycle():
+    """Ensure themes inheriting from themselves are reported."""
+    app = Flask('testing')
+    themer = Themer(app, loaders=[DictThemeLoader({
+        'a': ('b', {}),
+        'b': ('a', {}),
+        'c': (None, {'c.html': 'C'}),
+    })])
+
+    with app.app_context():
+        with pytest.raises(ThemeError, match='inherits from itself'):
+            themer.resolve_template('a', 'a.html')
+
+        assert themer.resolve_template('c', 'c.html') == 'c'
+
+        # Broken themes don't stop others from being invalidated.
+        themer.invalidate('c')
+        assert 'c' not in themer._resolved
+
+
+def test_lazy_eviction():
+    """Ensure lookups for lazy themes are forgotten along with the theme."""
+    app = Flask('testing')
+    app.config['THEMER_LAZY_THEME_CACHE_SIZE'] = 1
+    themer = Themer(app, loaders=[DictThemeLoader({
+        'a': (None, {'a.html': 'A'}),
+        'b': (None, {'b.html': 'B'}),
+    }, lazy=True)])
+
+    with app.app_context():
+        assert themer.resolve_template('a', 'a.html') == 'a'
+        assert themer.resolve_template('b', 'b.html') == 'b'
+        assert list(themer._resolved) == ['b']
+
+        template = app.jinja_env.get_template(f'{MAGIC_PATH_PREFIX}/a/a.html')
+        assert template.render() == 'A'
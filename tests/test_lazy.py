@@ -0,0 +1,133 @@
+from pathlib import Path
+
+import pytest
+from flask import Flask
+from jinja2 import DictLoader
+
+from flask_themer import (
+    Themer,
+    Theme,
+    ThemeLoader,
+    FileSystemThemeLoader,
+    render_template,
+    lookup_static_theme_path
+)
+
+
+class DictThemeLoader(ThemeLoader):
+    """A lazy loader that only implements `themes`."""
+    lazy = True
+
+    def __init__(self, themes):
+        self._themes = themes
+
+    @property
+    def themes(self):
+        for name, templates in self._themes.items():
+            yield Theme(
+                name=name,
+                theme_loader=self,
+                jinja_loader=DictLoader(templates)
+            )
+
+
+@pytest.fixture
+def app():
+    app = Flask(
+        'testing',
+        template_folder=Path('tests') / 'data' / 'templates'
+    )
+    app.config['SERVER_NAME'] = 'testing'
+    app.config['THEMER_LAZY_THEME_CACHE_SIZE'] = 2
+
+    themer = Themer(app, loaders=[
+        DictThemeLoader({
+            'dict_theme': {'test.html': 'From a dict.'},
+            'test_theme': {'test.html': 'Overridden.'}
+        }),
+        FileSystemThemeLoader(
+            Path('tests') / 'data',
+            filter=lambda path: not path.name.startswith('_'),
+            lazy=True
+        )
+    ])
+    themer.current_theme_loader(lambda: 'test_theme')
+
+    with app.app_context():
+        yield app
+
+
+def test_lazy_discovery(app):
+    """Ensure themes from lazy loaders are only found when they're used."""
+    themer = app.extensions['themer']
+    assert themer.themes == {}
+    assert not themer._lazy_themes
+
+    assert render_template('test.html') == 'This is a test.'
+    assert render_template('inheritance.html') == (
+        'This is rendered in other_test_theme.'
+    )
+    assert list(themer._lazy_themes) == ['test_theme', 'other_test_theme']
+
+    # Later loaders take precedence over earlier ones.
+    with app.test_client() as client:
+        rv = client.get(lookup_static_theme_path('static.txt'))
+        assert rv.data.strip() == b'This is a static asset test.'
+
+    # Only the most recently used themes are kept.
+    assert themer.get_theme('dict_theme').name == 'dict_theme'
+    assert list(themer._lazy_themes) == ['test_theme', 'dict_theme']
+    assert themer.get_theme('test_theme') is themer.get_theme('test_theme')
+
+
+def test_missing_themes(app):
+    """Ensure unknown themes, and names that aren't themes, can't be
+    found."""
+    themer = app.extensions['themer']
+
+    for name in (
+        'missing', '', '.', '..', 'a/b', 'not_a_dir', '_excluded_dir'
+    ):
+        assert themer.get_theme(name) is None
+
+    with app.test_client() as client:
+        rv = client.get('http://testing/_theme/missing/static.txt')
+        assert rv.status_code == 404
+
+
+def test_iter_themes(app):
+    """Ensure every theme can be listed, including lazy ones."""
+    themer = app.extensions['themer']
+    themer.themes['eager'] = Theme(
+        name='eager',
+        theme_loader=None,
+        jinja_loader=None
+    )
+
+    themes = {theme.name: theme for theme in themer.iter_themes()}
+    assert sorted(themes) == [
+        'dict_theme',
+        'eager',
+        'other_test_theme',
+        'templates',
+        'test_theme'
+    ]
+    assert isinstance(themes['test_theme'].theme_loader, FileSystemThemeLoader)
+
+
+def test_invalidate(app):
+    """Ensure lazy themes are forgotten when invalidated or refreshed."""
+    themer = app.extensions['themer']
+
+    themer.get_theme('test_theme')
+    themer.get_theme('dict_theme')
+
+    themer.invalidate('test_theme')
+    assert list(themer._lazy_themes) == ['dict_theme']
+
+    themer.invalidate()
+    assert not themer._lazy_themes
+
+    themer.get_theme('test_theme')
+    themer.refresh()
+    assert not themer._lazy_themes
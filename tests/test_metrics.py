@@ -0,0 +1,215 @@
+from pathlib import Path
+
+import pytest
+from flask import Flask
+from jinja2 import TemplateNotFound
+
+from flask_themer import (
+    Themer,
+    FileSystemThemeLoader,
+    Metrics,
+    MAGIC_PATH_PREFIX,
+    render_template
+)
+
+
+@pytest.fixture
+def app():
+    app = Flask(
+        'testing',
+        template_folder=Path('tests') / 'data' / 'templates'
+    )
+    app.config['SERVER_NAME'] = 'testing'
+    app.config['THEMER_METRICS_ENDPOINT'] = '/metrics'
+    app.config['THEMER_STATIC_CACHE_SIZE'] = 1024
+
+    themer = Themer(app, loaders=[
+        FileSystemThemeLoader(Path('tests') / 'data')
+    ])
+    themer.current_theme_loader(lambda: 'test_theme')
+
+    with app.app_context():
+        yield app
+
+
+def counters(app, name):
+    return {
+        tuple(sorted(sample['labels'].items())): sample['value']
+        for sample in app.extensions['themer'].metrics.snapshot()[
+            'counters'
+        ].get(name, [])
+    }
+
+
+def test_disabled():
+    """Ensure nothing is recorded unless metrics are enabled."""
+    app = Flask('testing')
+    themer = Themer(app, loaders=[])
+    themer.current_theme_loader(lambda: 'test_theme')
+    assert themer.metrics is None
+
+    with app.app_context():
+        assert themer.current_theme == 'test_theme'
+
+
+def test_histogram():
+    """Ensure histogram values are counted in the right buckets."""
+    metrics = Metrics(buckets=[1, 0.1])
+    metrics.observe('latency', 0.05, theme='a')
+    metrics.observe('latency', 0.5, theme='a')
+    metrics.observe('latency', 5, theme='a')
+
+    assert metrics.snapshot() == {
+        'counters': {},
+        'histograms': {
+            'latency': [{
+                'labels': {'theme': 'a'},
+                'count': 3,
+                'sum': 5.55,
+                'buckets': {0.1: 1, 1: 2, float('inf'): 3}
+            }]
+        }
+    }
+
+    metrics.reset()
+    assert metrics.snapshot() == {'counters': {}, 'histograms': {}}
+
+
+def test_prometheus():
+    """Ensure metrics are exported in the Prometheus text format."""
+    metrics = Metrics(buckets=[0.5])
+    metrics.inc('themer_render_total', theme='a"\\\n', result='hit')
+    metrics.inc('themer_render_total', theme='a"\\\n', result='hit')
+    metrics.inc('other_total')
+    metrics.observe('themer_resolver_seconds', 0.25)
+
+    assert metrics.to_prometheus() == (
+        '# TYPE other_total counter\n'
+        'other_total 1\n'
+        '# HELP themer_render_total Templates rendered by render_template, '
+        'by theme and result.\n'
+        '# TYPE themer_render_total counter\n'
+        'themer_render_total{result="hit",theme="a\\"\\\\\\n"} 2\n'
+        '# HELP themer_resolver_seconds Time spent in the current theme '
+        'resolver.\n'
+        '# TYPE themer_resolver_seconds histogram\n'
+        'themer_resolver_seconds_bucket{le="0.5"} 1\n'
+        'themer_resolver_seconds_bucket{le="+Inf"} 1\n'
+        'themer_resolver_seconds_sum 0.25\n'
+        'themer_resolver_seconds_count 1\n'
+    )
+
+
+def test_render(app):
+    """Ensure themed hits, fallbacks and the resolver are recorded."""
+    with app.test_request_context():
+        assert render_template('test.html').strip() == 'This is a test.'
+        render_template('fallback.html')
+        app.extensions['themer'].forget_current_theme()
+        render_template('fallback.html')
+
+    assert counters(app, 'themer_render_total') == {
+        (('result', 'hit'), ('theme', 'test_theme')): 1,
+        (('result', 'fallback'), ('theme', 'test_theme')): 2
+    }
+    assert counters(app, 'themer_resolver_calls_total') == {(): 2}
+
+    histograms = app.extensions['themer'].metrics.snapshot()['histograms']
+    assert histograms['themer_resolver_seconds'][0]['count'] == 2
+
+
+def test_template_misses(app):
+    """Ensure themed templates that can't be found are recorded by
+    reason."""
+    for name in (
+        f'{MAGIC_PATH_PREFIX}/bad_path',
+        f'{MAGIC_PATH_PREFIX}/unknown_theme/test.html',
+        f'{MAGIC_PATH_PREFIX}/test_theme/missing.html'
+    ):
+        with pytest.raises(TemplateNotFound):
+            app.jinja_env.get_template(name)
+
+    assert counters(app, 'themer_template_misses_total') == {
+        (('reason', 'bad_path'),): 1,
+        (('reason', 'unknown_theme'),): 1,
+        (('reason', 'missing_file'),): 1
+    }
+
+
+def test_template_removed(app, tmp_path):
+    """Ensure a template that disappears after being resolved is recorded
+    as missing."""
+    (tmp_path / 'theme').mkdir()
+    (tmp_path / 'theme' / 'page.html').write_text('Page')
+    themer = app.extensions['themer']
+    themer.themes.update(
+        (t.name, t) for t in FileSystemThemeLoader(tmp_path).themes
+    )
+
+    assert themer.resolve_template('theme', 'page.html') == 'theme'
+    (tmp_path / 'theme' / 'page.html').unlink()
+
+    with pytest.raises(TemplateNotFound):
+        app.jinja_env.get_template(f'{MAGIC_PATH_PREFIX}/theme/page.html')
+
+    assert counters(app, 'themer_template_misses_total') == {
+        (('reason', 'missing_file'),): 1
+    }
+
+
+def test_static(app):
+    """Ensure static responses are recorded by theme and status code, with
+    themes that don't exist sharing a single label."""
+    with app.test_client() as client:
+        rv = client.get('http://testing/_theme/test_theme/static.txt')
+        size = len(rv.data)
+        client.get('http://testing/_theme/test_theme/static.txt')
+        client.get('http://testing/_theme/test_theme/missing.txt')
+        client.get('http://testing/_theme/unknown_theme/static.txt')
+        client.get('http://testing/_theme/made_up/static.txt')
+
+    assert counters(app, 'themer_static_responses_total') == {
+        (('status', 200), ('theme', 'test_theme')): 2,
+        (('status', 404), ('theme', 'test_theme')): 1,
+        (('status', 404), ('theme', 'unknown')): 2
+    }
+    assert counters(app, 'themer_static_bytes_total') == {
+        (('theme', 'test_theme'),): size * 2,
+        (('theme', 'unknown'),): 0
+    }
+    assert counters(app, 'themer_static_cache_requests_total') == {
+        (('result', 'hit'),): 1,
+        (('result', 'miss'),): 2
+    }
+
+
+def test_static_error(app, monkeypatch):
+    """Ensure unexpected errors serving static assets are recorded as a
+    server error."""
+    loader = app.extensions['themer'].themes['test_theme'].theme_loader
+
+    def fail(*args):
+        raise RuntimeError('Failed.')
+
+    monkeypatch.setattr(loader, 'get_static', fail)
+
+    with app.test_client() as client:
+        rv = client.get('http://testing/_theme/test_theme/static.txt')
+        assert rv.status_code == 500
+
+    assert counters(app, 'themer_static_responses_total') == {
+        (('status', 500), ('theme', 'test_theme')): 1
+    }
+
+
+def test_endpoint(app):
+    """Ensure metrics are served from the configured endpoint."""
+    with app.test_client() as client:
+        client.get('http://testing/_theme/test_theme/static.txt')
+        rv = client.get('http://testing/metrics')
+
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/plain'
+    assert b'# TYPE themer_static_responses_total counter\n' in rv.data
+    assert b'themer_static_seconds_bucket{theme="test_theme",le="+Inf"} 1\n' \
+        in rv.data
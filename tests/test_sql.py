@@ -0,0 +1,281 @@
+import hashlib
+import sqlite3
+import threading
+
+import pytest
+from flask import Flask
+from jinja2 import TemplateNotFound
+
+from flask_themer import (
+    Themer,
+    ConnectionPool,
+    SQLThemeLoader,
+    SQLTemplateLoader,
+    render_template,
+    lookup_static_theme_path
+)
+
+
+@pytest.fixture
+def connect(tmp_path):
+    path = tmp_path / 'themes.db'
+    with sqlite3.connect(path) as db:
+        db.execute(
+            'CREATE TABLE theme_files ('
+            'theme TEXT NOT NULL, '
+            'path TEXT NOT NULL, '
+            'content BLOB NOT NULL, '
+            'version INTEGER NOT NULL, '
+            'PRIMARY KEY (theme, path))'
+        )
+        db.executemany('INSERT INTO theme_files VALUES (?, ?, ?, ?)', [
+            ('first', 'test.html', b'Hello from {{ name }}.', 1),
+            ('first', 'sub/text.html', 'Stored as text.', 1),
+            ('first', 'static/site.css', b'body { color: red; }', 1),
+            ('second', 'test.html', b'Hello from second.', 1),
+            ('child', 'other.html', b'Child.', 1)
+        ])
+
+    def connect():
+        return sqlite3.connect(path, check_same_thread=False)
+    return connect
+
+
+@pytest.fixture
+def app(connect):
+    app = Flask('testing')
+    app.config['SERVER_NAME'] = 'testing'
+
+    themer = Themer(app, loaders=[
+        SQLThemeLoader(connect, parents={'child': 'first'})
+    ])
+    themer.current_theme_loader(lambda: 'first')
+
+    with app.app_context():
+        yield app
+
+
+def update(connect, theme, path, content, version):
+    with connect() as db:
+        db.execute(
+            'UPDATE theme_files SET content = ?, version = ? '
+            'WHERE theme = ? AND path = ?',
+            (content, version, theme, path)
+        )
+
+
+def test_themes(app):
+    """Ensure every theme in the table is discovered."""
+    themes = app.extensions['themer'].themes
+    assert sorted(themes) == ['child', 'first', 'second']
+    assert isinstance(themes['first'].jinja_loader, SQLTemplateLoader)
+    assert themes['child'].data == {'parent': 'first'}
+    assert themes['first'].jinja_loader.list_templates() == [
+        'static/site.css',
+        'sub/text.html',
+        'test.html'
+    ]
+
+
+def test_render(app):
+    """Ensure templates are rendered from the database, including through
+    inheritance."""
+    with app.test_request_context():
+        assert render_template('test.html', name='first') == \
+            'Hello from first.'
+        assert render_template('sub/text.html') == 'Stored as text.'
+
+        with pytest.raises(TemplateNotFound):
+            render_template('missing.html')
+
+        themer = app.extensions['themer']
+        assert themer.resolve_template('child', 'test.html') == 'first'
+        assert themer.resolve_template('child', '../test.html') is None
+
+
+def test_batch_loaded(app, monkeypatch):
+    """Ensure all of a theme's files are loaded with a single query, and
+    cached."""
+    loader = app.extensions['themer'].loaders[0]
+    queries = []
+    query = loader._query
+
+    def counting_query(sql, *params):
+        queries.append(sql)
+        return query(sql, *params)
+
+    monkeypatch.setattr(loader, '_query', counting_query)
+
+    with app.test_request_context():
+        render_template('test.html', name='first')
+        render_template('sub/text.html')
+        with app.test_client() as client:
+            assert client.get(
+                'http://testing/_theme/first/site.css'
+            ).data == b'body { color: red; }'
+
+    assert len(queries) == 1
+
+
+def test_cache_size(connect):
+    """Ensure only the most recently used themes are kept in memory."""
+    loader = SQLThemeLoader(connect, cache_size=2)
+    loader._files('first')
+    loader._files('second')
+    loader._files('first')
+    loader._files('child')
+
+    assert list(loader._cache) == ['first', 'child']
+
+
+def test_uptodate(app, connect):
+    """Ensure changed templates are reloaded when auto_reload is enabled."""
+    app.jinja_env.auto_reload = True
+
+    with app.test_request_context():
+        assert render_template('test.html', name='first') == \
+            'Hello from first.'
+        assert render_template('test.html', name='first') == \
+            'Hello from first.'
+
+        update(connect, 'first', 'test.html', b'Changed.', 2)
+        assert render_template('test.html') == 'Changed.'
+
+
+def test_lazy(connect):
+    """Ensure lazy themes are found in the database on demand."""
+    loader = SQLThemeLoader(connect, lazy=True)
+    app = Flask('testing')
+    themer = Themer(app, loaders=[loader])
+    assert not themer.themes
+
+    with app.app_context():
+        assert themer.get_theme('second').name == 'second'
+        assert themer.get_theme('missing') is None
+
+
+def test_static(app):
+    """Ensure static assets are served from the database."""
+    with app.test_request_context():
+        url = lookup_static_theme_path('site.css')
+
+    with app.test_client() as client:
+        rv = client.get(url)
+        assert rv.status_code == 200
+        assert rv.mimetype == 'text/css'
+        assert rv.data == b'body { color: red; }'
+        assert rv.get_etag() == (
+            hashlib.sha256(b'body { color: red; }').hexdigest(),
+            False
+        )
+
+        assert client.get(
+            'http://testing/_theme/first/missing.css'
+        ).status_code == 404
+        assert client.get(
+            'http://testing/_theme/first/../test.html'
+        ).status_code == 404
+
+
+def test_invalidate(app, connect):
+    """Ensure invalidating a theme picks up changes from the database."""
+    loader = app.extensions['themer'].loaders[0]
+    assert loader.get_static_digest('first', 'site.css') == \
+        hashlib.sha256(b'body { color: red; }').hexdigest()
+    assert loader.get_static_digest('first', 'missing.css') is None
+
+    update(connect, 'first', 'static/site.css', b'body {}', 2)
+    app.extensions['themer'].invalidate('first')
+    assert loader.get_static_digest('first', 'site.css') == \
+        hashlib.sha256(b'body {}').hexdigest()
+
+    update(connect, 'first', 'static/site.css', b'', 3)
+    app.extensions['themer'].invalidate()
+    assert loader.get_static_digest('first', 'site.css') == \
+        hashlib.sha256(b'').hexdigest()
+
+
+def test_placeholder(connect):
+    """Ensure the table and parameter marker can be changed."""
+    loader = SQLThemeLoader(
+        connect,
+        table='theme_files AS files',
+        placeholder=':1'
+    )
+    assert loader.get_theme('first').name == 'first'
+
+
+def test_pool_reuse():
+    """Ensure connections are reused, and never more than `size` are
+    open."""
+    opened = []
+
+    def connect():
+        opened.append(sqlite3.connect(':memory:', check_same_thread=False))
+        return opened[-1]
+
+    pool = ConnectionPool(connect, size=2)
+    with pool.connection() as first:
+        with pool.connection() as second:
+            assert first is not second
+
+            acquired = threading.Event()
+
+            def borrow():
+                with pool.connection():
+                    acquired.set()
+
+            thread = threading.Thread(target=borrow)
+            thread.start()
+            assert not acquired.wait(0.05)
+
+    thread.join()
+    assert acquired.is_set()
+
+    with pool.connection() as connection:
+        assert connection in (first, second)
+    assert len(opened) == 2
+
+    pool.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        first.execute('SELECT 1')
+
+
+def test_pool_errors():
+    """Ensure connections that fail are closed and replaced."""
+    failures = [RuntimeError('Failed to connect.')]
+    opened = []
+
+    def connect():
+        if failures:
+            raise failures.pop()
+        opened.append(sqlite3.connect(':memory:'))
+        return opened[-1]
+
+    pool = ConnectionPool(connect, size=1)
+    with pytest.raises(RuntimeError):
+        with pool.connection():
+            pass
+
+    with pytest.raises(sqlite3.OperationalError):
+        with pool.connection() as connection:
+            connection.execute('SELECT * FROM missing')
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        opened[0].execute('SELECT 1')
+
+    with pool.connection() as connection:
+        assert connection is opened[1]
+
+
+def test_pool_close_errors():
+    """Ensure errors closing a failed connection don't hide the original
+    error."""
+    class Connection:
+        def close(self):
+            raise RuntimeError('Failed to close.')
+
+    pool = ConnectionPool(Connection, size=1)
+    with pytest.raises(ValueError):
+        with pool.connection():
+            raise ValueError('Original error.')
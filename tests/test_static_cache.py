@@ -0,0 +1,132 @@
+import pytest
+from flask import Flask
+
+from flask_themer import Themer, FileSystemThemeLoader, StaticCache
+
+
+@pytest.fixture
+def app(tmp_path):
+    static = tmp_path / 'theme' / 'static'
+    static.mkdir(parents=True)
+    (static / 'small.txt').write_bytes(b'small')
+    (static / 'large.txt').write_bytes(b'x' * 100)
+
+    app = Flask('testing')
+    app.config['SERVER_NAME'] = 'testing'
+    app.config['THEMER_STATIC_CACHE_SIZE'] = 1024
+    app.config['THEMER_STATIC_CACHE_MAX_FILE_SIZE'] = 50
+    app.config['THEMER_STATIC_FINGERPRINT'] = True
+
+    Themer(app, loaders=[FileSystemThemeLoader(tmp_path)])
+
+    with app.app_context():
+        yield app
+
+
+def test_disabled():
+    """Ensure there's no cache unless it's configured."""
+    themer = Themer(Flask('testing'), loaders=[])
+    assert themer.static_cache is None
+    themer.invalidate()
+
+
+def test_serve_from_cache(app, tmp_path, monkeypatch):
+    """Ensure small assets are served from memory once cached."""
+    themer = app.extensions['themer']
+    cache = themer.static_cache
+    loader = themer.themes['theme'].theme_loader
+
+    with app.test_client() as client:
+        rv = client.get('http://testing/_theme/theme/small.txt')
+        assert rv.data == b'small'
+        etag = rv.get_etag()
+        assert (cache.hits, cache.misses, len(cache)) == (0, 1, 1)
+
+        def fail(*args):
+            raise AssertionError('Asset loaded from disk.')
+
+        monkeypatch.setattr(loader, 'get_static', fail)
+        monkeypatch.setattr(loader, 'get_static_digest', fail)
+
+        rv = client.get('http://testing/_theme/theme/small.txt')
+        assert rv.status_code == 200
+        assert rv.data == b'small'
+        assert rv.get_etag() == etag
+        assert rv.mimetype == 'text/plain'
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        rv = client.get(
+            'http://testing/_theme/theme/small.txt',
+            headers={'If-None-Match': f'"{etag[0]}"'}
+        )
+        assert rv.status_code == 304
+
+        rv = client.get(
+            f'http://testing/_theme/theme/small.txt?v={etag[0][:12]}'
+        )
+        assert rv.data == b'small'
+        assert rv.cache_control.immutable
+
+        # Clients accepting different encodings get their own entries.
+        monkeypatch.undo()
+        rv = client.get(
+            'http://testing/_theme/theme/small.txt',
+            headers={'Accept-Encoding': 'gzip'}
+        )
+        assert rv.data == b'small'
+        assert len(cache) == 2
+
+        # Large and missing assets are never cached.
+        rv = client.get('http://testing/_theme/theme/large.txt')
+        assert rv.data == b'x' * 100
+        rv = client.get('http://testing/_theme/theme/missing.txt')
+        assert rv.status_code == 404
+        assert len(cache) == 2
+
+    themer.invalidate('other')
+    assert len(cache) == 2
+    themer.invalidate('theme')
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_lru_eviction(app):
+    """Ensure the least recently used entries are evicted to stay within
+    the byte budget."""
+    cache = StaticCache(max_size=10, max_file_size=10)
+
+    def response(body):
+        return app.response_class(body)
+
+    assert cache.store(('a', 'one'), response(b'1111'), None)
+    assert cache.store(('a', 'two'), response(b'2222'), None)
+    assert cache.get(('a', 'one')).body == b'1111'
+
+    assert cache.store(('b', 'three'), response(b'3333'), None)
+    assert cache.get(('a', 'two')) is None
+    assert cache.get(('a', 'one')) is not None
+    assert cache.size == 8
+
+    # Replacing an entry doesn't count it twice.
+    assert cache.store(('b', 'three'), response(b'33'), None)
+    assert cache.size == 6
+
+    assert not cache.store(('a', 'big'), response(b'x' * 11), None)
+    assert not cache.store(
+        ('a', 'error'),
+        app.response_class(status=500),
+        None
+    )
+
+    sendfile = response(b'')
+    sendfile.headers['X-Sendfile'] = '/somewhere'
+    assert not cache.store(('a', 'sendfile'), sendfile, None)
+
+    streamed = app.response_class(iter([b'a']))
+    assert not cache.store(('a', 'streamed'), streamed, None)
+
+    cache.evict('b')
+    assert cache.size == 4
+    cache.evict()
+    assert cache.size == 0
+    assert len(cache) == 0
@@ -0,0 +1,163 @@
+import pytest
+from flask import Flask
+from werkzeug.routing import BuildError
+
+import flask_themer
+from flask_themer import (
+    Themer,
+    MAGIC_PATH_PREFIX,
+    lookup_static_theme_path
+)
+
+
+@pytest.fixture
+def app():
+    app = Flask('testing')
+    app.config['SERVER_NAME'] = 'testing'
+
+    themer = Themer(app, loaders=[])
+    themer.current_theme_loader(lambda: 'test_theme')
+
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Count the calls made to url_for."""
+    calls = []
+    url_for = flask_themer.url_for
+
+    def counting_url_for(*args, **kwargs):
+        calls.append((args, kwargs))
+        return url_for(*args, **kwargs)
+
+    monkeypatch.setattr(flask_themer, 'url_for', counting_url_for)
+    return calls
+
+
+def test_cached(app, calls):
+    """Ensure repeated lookups of the same URL skip url_for."""
+    for _ in range(3):
+        assert lookup_static_theme_path('a.css') == \
+            'http://testing/_theme/test_theme/a.css'
+    assert len(calls) == 1
+
+    assert lookup_static_theme_path('a.css', theme='other') == \
+        'http://testing/_theme/other/a.css'
+    assert lookup_static_theme_path('a.css', _scheme='https') == \
+        'https://testing/_theme/test_theme/a.css'
+    assert lookup_static_theme_path('a.css', _scheme='https') == \
+        'https://testing/_theme/test_theme/a.css'
+    assert len(calls) == 3
+
+
+def test_request_context(app, calls):
+    """Ensure URLs built for different hosts, schemes and mount points are
+    kept apart."""
+    for base_url, expected in (
+        ('http://testing/', 'http://testing/_theme/test_theme/a.css'),
+        ('https://testing/', 'https://testing/_theme/test_theme/a.css'),
+        ('http://testing/app/', 'http://testing/app/_theme/test_theme/a.css'),
+        ('http://testing/app/', 'http://testing/app/_theme/test_theme/a.css')
+    ):
+        with app.test_request_context(base_url=base_url):
+            assert lookup_static_theme_path('a.css', _external=True) == \
+                expected
+
+    assert len(calls) == 3
+
+
+def test_url_map_changed(app, calls):
+    """Ensure cached URLs are forgotten when the rules for static assets
+    change, but not when other routes are added."""
+    lookup_static_theme_path('a.css')
+    app.add_url_rule('/other', endpoint='other')
+    lookup_static_theme_path('a.css')
+    assert len(calls) == 1
+
+    app.add_url_rule(
+        '/assets/<theme>/<path:filename>',
+        endpoint=f'{MAGIC_PATH_PREFIX}.static'
+    )
+    assert lookup_static_theme_path('a.css') == \
+        'http://testing/_theme/test_theme/a.css'
+    assert len(calls) == 2
+
+
+def test_no_static_endpoint(calls):
+    """Ensure nothing is cached when the URL for static assets can't be
+    built."""
+    app = Flask('testing')
+    themer = Themer(app, loaders=[])
+    app.url_map._rules_by_endpoint.pop(f'{MAGIC_PATH_PREFIX}.static')
+
+    with app.test_request_context():
+        for _ in range(2):
+            with pytest.raises(BuildError):
+                lookup_static_theme_path('a.css', theme='test_theme')
+
+    assert len(calls) == 2
+    assert not themer._static_urls
+
+
+def test_url_defaults(app, calls):
+    """Ensure nothing is cached when url_defaults functions could change
+    the URL."""
+    @app.url_defaults
+    def add_version(endpoint, values):
+        values.setdefault('version', '1')
+
+    assert lookup_static_theme_path('a.css') == \
+        'http://testing/_theme/test_theme/a.css?version=1'
+    lookup_static_theme_path('a.css')
+    assert len(calls) == 2
+
+
+def test_unhashable(app, calls):
+    """Ensure arguments that can't be part of a key aren't cached."""
+    for _ in range(2):
+        assert lookup_static_theme_path('a.css', tag=['a', 'b']) == \
+            'http://testing/_theme/test_theme/a.css?tag=a&tag=b'
+    assert len(calls) == 2
+
+
+def test_bounded(app, calls):
+    """Ensure the cache is emptied once it's full."""
+    themer = app.extensions['themer']
+    themer._static_urls_size = 2
+
+    for path in ('a.css', 'b.css', 'c.css', 'a.css'):
+        lookup_static_theme_path(path)
+
+    assert len(calls) == 4
+    assert len(themer._static_urls) == 2
+
+
+def test_disabled(calls):
+    """Ensure nothing is cached when THEMER_STATIC_URL_CACHE_SIZE is 0."""
+    app = Flask('testing')
+    app.config['THEMER_STATIC_URL_CACHE_SIZE'] = 0
+    themer = Themer(app, loaders=[])
+
+    with app.test_request_context():
+        lookup_static_theme_path('a.css', theme='test_theme')
+        lookup_static_theme_path('a.css', theme='test_theme')
+
+    assert len(calls) == 2
+    assert not themer._static_urls
+
+
+def test_invalidate(app, calls):
+    """Ensure invalidating a theme forgets its URLs."""
+    themer = app.extensions['themer']
+    lookup_static_theme_path('a.css')
+    lookup_static_theme_path('a.css', theme='other')
+
+    themer.invalidate('other')
+    lookup_static_theme_path('a.css')
+    lookup_static_theme_path('a.css', theme='other')
+    assert len(calls) == 3
+
+    themer.invalidate()
+    assert not themer._static_urls
@@ -0,0 +1,221 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+from flask import Flask
+from jinja2 import Environment
+
+from flask_themer import (
+    Themer,
+    FileSystemThemeLoader,
+    ThemedTemplateCache,
+    TemplateCacheStats,
+    MAGIC_PATH_PREFIX,
+    render_template,
+    render_template_async
+)
+
+
+def key(theme, path='a.html'):
+    if theme is None:
+        return ('loader', path)
+    return ('loader', f'{MAGIC_PATH_PREFIX}/{theme}/{path}')
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """A cache where each template is a string weighing its length."""
+    monkeypatch.setattr(ThemedTemplateCache, '_weight', staticmethod(len))
+    return ThemedTemplateCache(10, theme_quota=6)
+
+
+@pytest.fixture
+def app():
+    app = Flask(
+        'testing',
+        template_folder=Path('tests') / 'data' / 'templates'
+    )
+    app.config['THEMER_TEMPLATE_CACHE_SIZE'] = 1024 * 1024
+
+    themer = Themer(app, loaders=[
+        FileSystemThemeLoader(Path('tests') / 'data')
+    ])
+    themer.current_theme_loader(lambda: 'test_theme')
+
+    with app.app_context():
+        yield app
+
+
+def test_weight():
+    """Ensure templates are weighed by the size of their compiled code."""
+    env = Environment()
+    small = env.from_string('Hello.')
+    large = env.from_string(
+        '{% macro item(x) %}<li>{{ x }}</li>{% endmacro %}'
+        '{% block body %}{% for x in y %}{{ item(x) }}{% endfor %}'
+        '{% endblock %}'
+    )
+
+    assert 0 < ThemedTemplateCache._weight(small) < \
+        ThemedTemplateCache._weight(large)
+
+
+def test_get_set(cache):
+    """Ensure templates can be stored, found and removed."""
+    cache[key('a')] = 'aa'
+    cache[key(None)] = 'app'
+
+    assert cache[key('a')] == 'aa'
+    assert cache.get(key('a', 'missing')) is None
+    assert cache.get(key('b')) is None
+    assert key(None) in cache
+    assert key('b') not in cache
+    assert len(cache) == 2
+    assert cache.size == 5
+    assert cache.themes() == ['a']
+
+    with pytest.raises(KeyError):
+        cache[key('b')]
+
+    cache[key('a')] = 'aaa'
+    assert cache.size == 6
+
+    # Only themes with cached templates have statistics.
+    assert cache.stats() == {
+        'a': TemplateCacheStats(hits=1, misses=1, templates=1, size=3),
+        None: TemplateCacheStats(templates=1, size=3)
+    }
+
+    del cache[key('a')]
+    assert cache.keys() == [key(None)]
+    with pytest.raises(KeyError):
+        del cache[key('a')]
+
+    # ... and they're dropped along with the theme's last template.
+    assert cache.stats() == {
+        None: TemplateCacheStats(templates=1, size=3)
+    }
+
+    cache.clear()
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_theme_quota(cache):
+    """Ensure a theme can't use more than its quota, dropping its own least
+    recently used templates first."""
+    cache[key('a', '1')] = 'aa'
+    cache[key('a', '2')] = 'aa'
+    cache[key('a', '1')]
+    cache[key('a', '3')] = 'aaa'
+
+    assert cache.keys() == [key('a', '1'), key('a', '3')]
+    assert cache.stats()['a'].evictions == 1
+
+    # A single template larger than the quota is still cached.
+    cache[key('b')] = 'b' * 8
+    assert key('b') in cache
+
+
+def test_coldest_theme_evicted(cache):
+    """Ensure the least recently used theme is dropped first when the cache
+    is full."""
+    cache[key('hot')] = 'hhh'
+    cache[key('cold')] = 'ccc'
+    cache[key('hot')]
+    cache[key('new')] = 'nnnnn'
+
+    assert cache.themes() == ['hot', 'new']
+    assert cache.size == 8
+    assert 'cold' not in cache.stats()
+
+    cache[key('huge')] = 'x' * 20
+    assert cache.themes() == ['huge']
+
+
+def test_stats_bounded(cache):
+    """Ensure statistics are only kept for themes that are cached, however
+    many themes are looked up."""
+    for i in range(100):
+        cache.get(key(str(i)))
+        cache[key(str(i))] = 'xxxxx'
+
+    assert len(cache.stats()) == len(cache.themes()) == 2
+
+
+def test_evict(cache):
+    """Ensure every template for a theme can be removed."""
+    cache[key('a', '1')] = 'a'
+    cache[key('a', '2')] = 'a'
+    cache[key('b')] = 'b'
+
+    cache.evict('a')
+    assert cache.keys() == [key('b')]
+    cache.evict('missing')
+
+
+def test_configured(app):
+    """Ensure the cache replaces Jinja's own when configured, and is used
+    for themed and app templates alike."""
+    cache = app.jinja_env.cache
+    assert isinstance(cache, ThemedTemplateCache)
+    assert cache.max_size == cache.theme_quota == 1024 * 1024
+
+    with app.test_request_context():
+        assert render_template('test.html') == 'This is a test.'
+        assert render_template('test.html') == 'This is a test.'
+        render_template('fallback.html')
+
+    stats = cache.stats()
+    assert stats['test_theme'].hits == 1
+    assert stats['test_theme'].templates == 1
+    assert stats[None].templates == 1
+
+
+def test_invalidate(app):
+    """Ensure invalidating a theme drops its templates."""
+    themer = app.extensions['themer']
+    cache = app.jinja_env.cache
+
+    with app.test_request_context():
+        render_template('test.html')
+        render_template('fallback.html')
+        assert cache.themes() == ['test_theme']
+
+        themer.invalidate('test_theme')
+        assert cache.themes() == []
+
+        render_template('test.html')
+        themer.invalidate()
+        assert cache.themes() == []
+        assert len(cache) == 1
+
+
+def test_async(app):
+    """Ensure async templates get a cache of their own."""
+    asyncio.run(render_template_async('test.html'))
+
+    cache = app.extensions['themer']._async_env.cache
+    assert isinstance(cache, ThemedTemplateCache)
+    assert cache is not app.jinja_env.cache
+    assert cache.themes() == ['test_theme']
+
+
+def test_copy(app):
+    """Ensure copies are empty and keep the same limits, and that the cache
+    works with overlays."""
+    cache = app.jinja_env.cache
+    with app.test_request_context():
+        render_template('test.html')
+
+    copy = cache.copy()
+    assert isinstance(copy, ThemedTemplateCache)
+    assert len(copy) == 0
+    assert (copy.max_size, copy.theme_quota) == \
+        (cache.max_size, cache.theme_quota)
+    assert cache.capacity == cache.max_size
+
+    overlay = app.jinja_env.overlay()
+    assert overlay.get_template('fallback.html').render() == \
+        'This is a fallback template.'
+    assert overlay.cache is not cache
+    assert len(overlay.cache) == 1
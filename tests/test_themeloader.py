@@ -1,16 +1,23 @@
+import os
+import hashlib
 from pathlib import Path
 
 import pytest
 from flask import Flask
-from jinja2 import TemplateNotFound
+from jinja2 import Environment, TemplateNotFound
+from werkzeug.exceptions import NotFound
 
 from flask_themer import (
     Themer,
     FileSystemThemeLoader,
     render_template,
+    stream_template,
     ThemeLoader,
+    IndexedFileSystemLoader,
     lookup_static_theme_path,
-    MAGIC_PATH_PREFIX
+    MAGIC_PATH_PREFIX,
+    _DirectDispatchLoader,
+    compress_static_file
 )
 
 
@@ -43,6 +50,24 @@ def test_fallback(app):
     assert render_template('fallback.html') == 'This is a fallback template.'
 
 
+def test_stream_template(app):
+    """Ensure templates can be streamed from the theme, with the same
+    fallback as render_template."""
+    @app.route('/stream/<path:path>')
+    def stream(path):
+        return app.response_class(stream_template(path))
+
+    assert ''.join(stream_template('test.html')) == 'This is a test.'
+    assert ''.join(stream_template('fallback.html')) == (
+        'This is a fallback template.'
+    )
+
+    with app.test_client() as client:
+        rv = client.get('http://testing/stream/test.html')
+        assert rv.is_streamed
+        assert rv.data == b'This is a test.'
+
+
 def test_inheritance(app):
     """Ensure themes can inherit from other themes."""
     with app.app_context():
@@ -72,6 +97,8 @@ def test_interface():
     with pytest.raises(NotImplementedError):
         loader.get_static('', '')
 
+    assert loader.get_static_digest('', '') is None
+
 
 def test_static(app):
     """Ensure we can get a static file from the theme or fail reasonably if
@@ -101,3 +128,479 @@ def test_bad_template_path(app):
     """Ensure we handle bad paths ending up in our blueprint."""
     with pytest.raises(TemplateNotFound):
         render_template(f'{MAGIC_PATH_PREFIX}/')
+
+
+def test_fallback_cache(app):
+    """Ensure misses are remembered so later renders skip straight to the
+    fallback, and that invalidation forgets them."""
+    themer = app.extensions['themer']
+
+    assert render_template('fallback.html') == 'This is a fallback template.'
+    assert themer._resolved['test_theme']['fallback.html'] is None
+
+    assert render_template('fallback.html') == 'This is a fallback template.'
+
+    themer.invalidate('other_test_theme')
+    assert 'fallback.html' in themer._resolved['test_theme']
+
+    themer.invalidate('test_theme')
+    assert not themer._resolved
+
+    render_template('fallback.html')
+    themer.invalidate()
+    assert not themer._resolved
+
+
+def test_fallback_cache_nested_miss(app):
+    """Ensure a missing template included from a themed template isn't
+    mistaken for the themed template itself being missing."""
+    themer = app.extensions['themer']
+
+    with pytest.raises(TemplateNotFound):
+        render_template('use_fallback.html')
+
+    assert themer._resolved['test_theme']['use_fallback.html'] == 'test_theme'
+
+
+def test_fallback_cache_auto_reload(app):
+    """Ensure misses aren't remembered when templates are auto-reloaded."""
+    themer = app.extensions['themer']
+    app.jinja_env.auto_reload = True
+
+    assert render_template('fallback.html') == 'This is a fallback template.'
+    assert not themer._resolved
+
+
+def test_unknown_theme(app):
+    """Ensure an unknown theme falls back without attempting a themed lookup,
+    and that referencing one directly fails reasonably."""
+    themer = app.extensions['themer']
+    themer.current_theme_loader(lambda: 'missing_theme')
+
+    assert render_template('fallback.html') == 'This is a fallback template.'
+    assert not themer._resolved
+
+    with pytest.raises(TemplateNotFound):
+        app.jinja_env.get_template(f'{MAGIC_PATH_PREFIX}/missing_theme/a.html')
+
+
+def test_indexed_loader(app, tmp_path):
+    """Ensure the indexed loader finds templates from its index and notices
+    when they change."""
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'a.html').write_text('A')
+    (tmp_path / 'b.html').write_text('B')
+
+    loader = IndexedFileSystemLoader(tmp_path)
+    assert loader.list_templates() == ['b.html', 'sub/a.html']
+    assert 'sub/a.html' in loader
+    assert 'missing.html' not in loader
+    assert '../escape.html' not in loader
+
+    source, filename, uptodate = loader.get_source(app.jinja_env, 'sub/a.html')
+    assert source == 'A'
+    assert filename == str(tmp_path / 'sub' / 'a.html')
+    assert uptodate()
+
+    with pytest.raises(TemplateNotFound):
+        loader.get_source(app.jinja_env, 'missing.html')
+
+    # Files added after indexing are invisible until we reindex.
+    (tmp_path / 'c.html').write_text('C')
+    assert 'c.html' not in loader
+    loader.reindex()
+    assert 'c.html' in loader
+
+    os.utime(tmp_path / 'sub' / 'a.html', (0, 0))
+    assert not uptodate()
+
+    # Once reloaded, a changed file is up to date again.
+    source, filename, uptodate = loader.get_source(app.jinja_env, 'sub/a.html')
+    assert uptodate()
+
+    # Files removed after indexing.
+    (tmp_path / 'sub' / 'a.html').unlink()
+    assert not uptodate()
+    with pytest.raises(TemplateNotFound):
+        loader.get_source(app.jinja_env, 'sub/a.html')
+
+
+def test_indexed_loader_auto_reload(tmp_path):
+    """Ensure a changed template is compiled once, not on every render."""
+    (tmp_path / 'a.html').write_text('A')
+    env = Environment(
+        loader=IndexedFileSystemLoader(tmp_path),
+        auto_reload=True
+    )
+    compiled = []
+    compile = env.compile
+
+    def counting_compile(*args, **kwargs):
+        compiled.append(args)
+        return compile(*args, **kwargs)
+
+    env.compile = counting_compile
+    assert env.get_template('a.html').render() == 'A'
+
+    (tmp_path / 'a.html').write_text('B')
+    os.utime(tmp_path / 'a.html', (0, 0))
+    for _ in range(3):
+        assert env.get_template('a.html').render() == 'B'
+
+    assert len(compiled) == 2
+
+
+def test_indexed_loader_broken_link(tmp_path):
+    """Ensure files that vanish or can't be read while indexing are
+    skipped."""
+    (tmp_path / 'broken.html').symlink_to(tmp_path / 'nowhere.html')
+
+    loader = IndexedFileSystemLoader(tmp_path)
+    assert loader.list_templates() == []
+
+
+def test_indexed_loader_symlinks(tmp_path):
+    """Ensure symlinked directories are indexed, without looping forever
+    on links back to a parent."""
+    (tmp_path / 'shared').mkdir()
+    (tmp_path / 'shared' / 'a.html').write_text('A')
+    (tmp_path / 'theme').mkdir()
+    (tmp_path / 'theme' / 'shared').symlink_to(tmp_path / 'shared')
+    (tmp_path / 'theme' / 'shared-again').symlink_to(tmp_path / 'shared')
+    (tmp_path / 'shared' / 'loop').symlink_to(tmp_path / 'theme')
+
+    loader = IndexedFileSystemLoader(tmp_path / 'theme')
+    assert loader.list_templates() == ['shared-again/a.html', 'shared/a.html']
+
+
+def test_indexed_loader_vanishing_directory(tmp_path, monkeypatch):
+    """Ensure directories that vanish while indexing are skipped."""
+    (tmp_path / 'gone').mkdir()
+    (tmp_path / 'gone' / 'a.html').write_text('A')
+    (tmp_path / 'b.html').write_text('B')
+    stat = os.stat
+
+    def vanishing_stat(path, *args, **kwargs):
+        if str(path) == str(tmp_path / 'gone'):
+            raise FileNotFoundError(path)
+        return stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, 'stat', vanishing_stat)
+    loader = IndexedFileSystemLoader(tmp_path)
+    assert loader.list_templates() == ['b.html']
+
+
+def test_indexed_theme_loader_invalidate(tmp_path):
+    """Ensure a lazy theme's index is shared by every instance of the theme,
+    and rebuilt when the theme is invalidated."""
+    (tmp_path / 'theme').mkdir()
+    (tmp_path / 'theme' / 'a.html').write_text('A')
+    (tmp_path / 'other').mkdir()
+
+    app = Flask('testing')
+    loader = FileSystemThemeLoader(tmp_path, index=True, lazy=True)
+    themer = Themer(app, loaders=[loader])
+
+    with app.app_context():
+        index = themer.get_theme('theme').jinja_loader
+        assert themer.resolve_template('theme', 'b.html') is None
+        assert loader.get_theme('theme').jinja_loader is index
+        other = themer.get_theme('other').jinja_loader
+        assert other.list_templates() == []
+
+        (tmp_path / 'theme' / 'b.html').write_text('B')
+        assert 'b.html' not in index
+
+        themer.invalidate('theme')
+        assert themer.resolve_template('theme', 'b.html') == 'theme'
+        assert themer.get_theme('theme').jinja_loader is index
+        assert other._index is not None
+
+        themer.invalidate()
+        assert other._index is None
+
+
+def test_invalidate_hook():
+    """Ensure every theme loader is told when themes are invalidated."""
+    class RecordingThemeLoader(ThemeLoader):
+        themes = ()
+
+        def __init__(self):
+            self.invalidated = []
+
+        def invalidate(self, theme=None):
+            self.invalidated.append(theme)
+
+    loader = RecordingThemeLoader()
+    themer = Themer(Flask('testing'), loaders=[
+        FileSystemThemeLoader(Path('tests') / 'data'),
+        loader
+    ])
+    themer.invalidate('test_theme')
+    themer.invalidate()
+    assert loader.invalidated == ['test_theme', None]
+
+
+def test_indexed_theme_loader():
+    """Ensure themes can be loaded using an index."""
+    app = Flask(
+        'testing',
+        template_folder=Path('tests') / 'data' / 'templates'
+    )
+
+    themer = Themer(app, loaders=[
+        FileSystemThemeLoader(Path('tests') / 'data', index=True)
+    ])
+    themer.current_theme_loader(lambda: 'test_theme')
+
+    assert isinstance(
+        themer.themes['test_theme'].jinja_loader,
+        IndexedFileSystemLoader
+    )
+
+    with app.app_context():
+        assert render_template('test.html') == 'This is a test.'
+        assert render_template('fallback.html') == (
+            'This is a fallback template.'
+        )
+
+
+def test_direct_dispatch(monkeypatch):
+    """Ensure themed templates can be dispatched directly to the theme loader
+    without going through Flask's blueprint loaders."""
+    app = Flask(
+        'testing',
+        template_folder=Path('tests') / 'data' / 'templates'
+    )
+    app.config['THEMER_DIRECT_DISPATCH'] = True
+
+    themer = Themer(app, loaders=[
+        FileSystemThemeLoader(Path('tests') / 'data')
+    ])
+    themer.current_theme_loader(lambda: 'test_theme')
+
+    loader = app.jinja_env.loader
+    assert isinstance(loader, _DirectDispatchLoader)
+
+    assert _DirectDispatchLoader(
+        app.jinja_loader
+    ).list_templates() == ['fallback.html']
+
+    # Themed templates must never reach Flask's own loader.
+    looked_up = []
+    get_source = loader.loader.get_source
+
+    def recording_get_source(environment, template):
+        looked_up.append(template)
+        return get_source(environment, template)
+
+    monkeypatch.setattr(loader.loader, 'get_source', recording_get_source)
+
+    with app.app_context():
+        assert render_template('test.html') == 'This is a test.'
+        assert render_template('inheritance.html') == (
+            'This is rendered in other_test_theme.'
+        )
+        assert render_template('fallback.html') == (
+            'This is a fallback template.'
+        )
+
+    assert looked_up == ['fallback.html']
+
+
+def test_static_fingerprint(app):
+    """Ensure static URLs are fingerprinted when enabled, and that
+    fingerprinted URLs are served with far-future cache headers."""
+    app.config['THEMER_STATIC_FINGERPRINT'] = True
+
+    digest = hashlib.sha256(
+        (Path('tests') / 'data' / 'test_theme' / 'static' / 'static.txt')
+        .read_bytes()
+    ).hexdigest()
+
+    static_route = lookup_static_theme_path('static.txt')
+    assert static_route == (
+        f'http://testing/_theme/test_theme/static.txt?v={digest[:12]}'
+    )
+
+    # Assets we can't fingerprint are left alone.
+    assert lookup_static_theme_path('missing.txt') == (
+        'http://testing/_theme/test_theme/missing.txt'
+    )
+    assert lookup_static_theme_path('static.txt', theme='fake_theme') == (
+        'http://testing/_theme/fake_theme/static.txt'
+    )
+
+    with app.test_client() as client:
+        rv = client.get(static_route)
+        assert rv.status_code == 200
+        assert rv.cache_control.immutable
+        assert rv.cache_control.public
+        assert rv.cache_control.max_age == 31536000
+
+        # A stale or bogus fingerprint must not be cached forever.
+        rv = client.get('http://testing/_theme/test_theme/static.txt?v=bad')
+        assert rv.status_code == 200
+        assert not rv.cache_control.immutable
+
+        rv = client.get('http://testing/_theme/test_theme/missing.txt?v=bad')
+        assert rv.status_code == 404
+
+    app.config['THEMER_STATIC_FINGERPRINT'] = False
+    with app.test_client() as client:
+        rv = client.get(static_route)
+        assert not rv.cache_control.immutable
+
+
+def test_static_digest(tmp_path):
+    """Ensure static digests are cached until the file changes."""
+    static = tmp_path / 'theme' / 'static'
+    static.mkdir(parents=True)
+    (static / 'sub').mkdir()
+    (static / 'a.txt').write_bytes(b'first')
+
+    loader = FileSystemThemeLoader(tmp_path)
+
+    first = loader.get_static_digest('theme', 'a.txt')
+    assert first == hashlib.sha256(b'first').hexdigest()
+    assert loader.get_static_digest('theme', 'a.txt') == first
+
+    (static / 'a.txt').write_bytes(b'second!')
+    assert loader.get_static_digest('theme', 'a.txt') == (
+        hashlib.sha256(b'second!').hexdigest()
+    )
+
+    assert loader.get_static_digest('theme', 'missing.txt') is None
+    assert loader.get_static_digest('theme', 'sub') is None
+    assert loader.get_static_digest('theme', '../../a.txt') is None
+
+
+def test_static_precompressed(tmp_path):
+    """Ensure precompressed copies of static assets are served to clients
+    that accept them."""
+    static = tmp_path / 'theme' / 'static'
+    static.mkdir(parents=True)
+    (static / 'site.css').write_text('body { color: red; }\n' * 100)
+    (static / 'plain.css').write_text('body { color: blue; }\n' * 100)
+    compress_static_file(str(static / 'site.css'))
+
+    app = Flask('testing')
+    app.config['SERVER_NAME'] = 'testing'
+    loader = FileSystemThemeLoader(tmp_path, precompressed=True)
+    Themer(app, loaders=[loader])
+
+    with app.test_client() as client:
+        url = 'http://testing/_theme/theme/site.css'
+
+        rv = client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+        assert rv.content_encoding == 'br'
+        assert rv.mimetype == 'text/css'
+        assert 'Accept-Encoding' in rv.vary
+        assert rv.data == (static / 'site.css.br').read_bytes()
+
+        rv = client.get(url, headers={'Accept-Encoding': 'gzip, br;q=0'})
+        assert rv.content_encoding == 'gzip'
+        assert rv.data == (static / 'site.css.gz').read_bytes()
+
+        rv = client.get(url)
+        assert rv.content_encoding is None
+        assert 'Accept-Encoding' in rv.vary
+        assert rv.data == (static / 'site.css').read_bytes()
+
+        rv = client.get(
+            'http://testing/_theme/theme/plain.css',
+            headers={'Accept-Encoding': 'gzip, br'}
+        )
+        assert rv.content_encoding is None
+        assert rv.data == (static / 'plain.css').read_bytes()
+
+        # Copies older than the asset are out of date, and never served.
+        os.utime(static / 'site.css.br', (0, 0))
+        rv = client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+        assert rv.content_encoding == 'gzip'
+
+        # Neither are copies of an asset that no longer exists.
+        (static / 'site.css').unlink()
+        rv = client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+        assert rv.status_code == 404
+
+    (static / 'unknown.unknowntype').write_bytes(b'')
+    (static / 'unknown.unknowntype.gz').write_bytes(b'')
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        rv = loader.get_static('theme', 'unknown.unknowntype')
+        assert rv.mimetype == 'application/octet-stream'
+
+        with pytest.raises(NotFound):
+            loader.get_static('theme', '../escape')
+
+
+def test_static_etag(app, monkeypatch):
+    """Ensure static assets get strong, content-based ETags and that
+    revalidations are answered without loading the asset."""
+    app.config['THEMER_STATIC_FINGERPRINT'] = True
+    themer = app.extensions['themer']
+    loader = themer.themes['test_theme'].theme_loader
+
+    digest = hashlib.sha256(
+        (Path('tests') / 'data' / 'test_theme' / 'static' / 'static.txt')
+        .read_bytes()
+    ).hexdigest()
+    url = 'http://testing/_theme/test_theme/static.txt'
+
+    with app.test_client() as client:
+        rv = client.get(url)
+        assert rv.status_code == 200
+        assert rv.get_etag() == (digest, False)
+
+        def get_static(theme, path):
+            raise AssertionError('Asset loaded for a revalidation.')
+
+        monkeypatch.setattr(loader, 'get_static', get_static)
+
+        rv = client.get(url, headers={'If-None-Match': f'"{digest}"'})
+        assert rv.status_code == 304
+        assert rv.get_etag() == (digest, False)
+        assert not rv.cache_control.immutable
+
+        rv = client.get(url, headers={'If-None-Match': f'W/"{digest}-gzip"'})
+        assert rv.status_code == 304
+        assert rv.get_etag() == (f'{digest}-gzip', False)
+
+        rv = client.get(
+            f'{url}?v={digest[:12]}',
+            headers={'If-None-Match': f'"{digest}"'}
+        )
+        assert rv.status_code == 304
+        assert rv.cache_control.immutable
+
+        monkeypatch.undo()
+
+        rv = client.get(url, headers={'If-None-Match': '"stale"'})
+        assert rv.status_code == 200
+        assert rv.get_etag() == (digest, False)
+
+
+def test_static_etag_precompressed(tmp_path):
+    """Ensure precompressed assets get a different ETag from the original."""
+    static = tmp_path / 'theme' / 'static'
+    static.mkdir(parents=True)
+    (static / 'site.css').write_text('body { color: red; }\n' * 100)
+    compress_static_file(str(static / 'site.css'))
+    digest = hashlib.sha256((static / 'site.css').read_bytes()).hexdigest()
+
+    app = Flask('testing')
+    app.config['SERVER_NAME'] = 'testing'
+    Themer(app, loaders=[FileSystemThemeLoader(tmp_path, precompressed=True)])
+
+    with app.test_client() as client:
+        url = 'http://testing/_theme/theme/site.css'
+
+        rv = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert rv.content_encoding == 'gzip'
+        assert rv.get_etag() == (f'{digest}-gzip', False)
+
+        rv = client.get(url, headers={
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': f'"{digest}-gzip"'
+        })
+        assert rv.status_code == 304
@@ -1,9 +1,15 @@
+import logging
+import threading
+import time
+
 import pytest
 from flask import Flask, url_for
 from jinja2 import TemplateNotFound
 
 from flask_themer import (
     Themer,
+    Theme,
+    ThemeLoader,
     EXTENSION_KEY,
     MAGIC_PATH_PREFIX,
     render_template,
@@ -85,4 +91,129 @@ def test_use_theme(app):
             raise ValueError
 
     # Ensure nothing is left after every manager has closed.
-    assert len(themer._explicit_theme_stack) == 0
+    assert themer._explicit_theme_stack.get() == ()
+
+
+def test_use_theme_isolated(app):
+    """Ensure use_theme in one thread doesn't leak into another."""
+    themer: Themer = app.extensions[EXTENSION_KEY]
+    themer.current_theme_loader(lambda: 'test_theme')
+
+    entered = threading.Event()
+    done = threading.Event()
+    seen = []
+
+    def worker():
+        with app.app_context():
+            with use_theme('test_use'):
+                entered.set()
+                done.wait(5)
+                seen.append(themer.current_theme)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+
+    entered.wait(5)
+    assert themer.current_theme == 'test_theme'
+    done.set()
+    thread.join()
+
+    assert seen == ['test_use']
+
+
+def test_current_theme_cached(app):
+    """Ensure the resolver is only called once per app context, that it can
+    be forgotten, and that use_theme still takes precedence."""
+    themer: Themer = app.extensions[EXTENSION_KEY]
+
+    calls = []
+
+    @themer.current_theme_loader
+    def resolver():
+        calls.append(True)
+        return 'test_theme'
+
+    assert themer.current_theme == 'test_theme'
+    assert themer.current_theme == 'test_theme'
+    assert len(calls) == 1
+
+    with use_theme('test_use'):
+        assert themer.current_theme == 'test_use'
+
+    themer.forget_current_theme()
+    assert themer.current_theme == 'test_theme'
+    assert len(calls) == 2
+
+    # A new app context gets its own theme.
+    with app.app_context():
+        assert themer.current_theme == 'test_theme'
+        assert len(calls) == 3
+
+
+def test_current_theme_not_cached(app):
+    """Ensure the resolver is called every time when caching is disabled or
+    there is no app context."""
+    themer: Themer = app.extensions[EXTENSION_KEY]
+    app.config['THEMER_CACHE_CURRENT_THEME'] = False
+
+    calls = []
+
+    @themer.current_theme_loader
+    def resolver():
+        calls.append(True)
+        return 'test_theme'
+
+    assert themer.current_theme == 'test_theme'
+    assert themer.current_theme == 'test_theme'
+    assert len(calls) == 2
+
+
+def test_current_theme_no_context():
+    """Ensure the resolver is called every time outside of an app context."""
+    themer = Themer(Flask('testing'), loaders=[])
+
+    calls = []
+
+    @themer.current_theme_loader
+    def resolver():
+        calls.append(True)
+        return 'test_theme'
+
+    assert themer.current_theme == 'test_theme'
+    assert themer.current_theme == 'test_theme'
+    assert len(calls) == 2
+
+
+class BarrierThemeLoader(ThemeLoader):
+    """Waits for every other loader sharing `barrier` before returning its
+    themes, which only works if they're all asked at the same time."""
+    def __init__(self, barrier, *names):
+        self.barrier = barrier
+        self.names = names
+
+    @property
+    def themes(self):
+        self.barrier.wait()
+        for name in self.names:
+            yield Theme(name=name, theme_loader=self, jinja_loader=None)
+
+
+def test_concurrent_discovery(caplog):
+    """Ensure loaders discover their themes at the same time, while later
+    loaders still take precedence."""
+    caplog.set_level(logging.DEBUG, logger='testing')
+
+    # Loaders asked one after the other would break the barrier instead.
+    barrier = threading.Barrier(3, timeout=5)
+    first = BarrierThemeLoader(barrier, 'a', 'b')
+    second = BarrierThemeLoader(barrier, 'b', 'c')
+    third = BarrierThemeLoader(barrier, 'c')
+
+    themer = Themer(Flask('testing'), loaders=[first, second, third])
+
+    assert themer.themes['a'].theme_loader is first
+    assert themer.themes['b'].theme_loader is second
+    assert themer.themes['c'].theme_loader is third
+
+    assert caplog.text.count('Discovered') == 3
+    assert 'Discovered 2 themes from' in caplog.text
@@ -0,0 +1,116 @@
+from pathlib import Path
+
+from flask import Flask
+from jinja2.loaders import BaseLoader
+from jinja2.utils import LRUCache
+
+from flask_themer import (
+    Themer,
+    Theme,
+    ThemeLoader,
+    FileSystemThemeLoader,
+    MAGIC_PATH_PREFIX,
+    render_template
+)
+
+
+class UnlistableThemeLoader(ThemeLoader):
+    @property
+    def themes(self):
+        yield Theme(
+            name='unlistable',
+            theme_loader=self,
+            jinja_loader=BaseLoader()
+        )
+
+
+def make_app(**config):
+    app = Flask(
+        'testing',
+        template_folder=Path('tests') / 'data' / 'templates'
+    )
+    app.config.update(config)
+    themer = Themer(app, loaders=[
+        FileSystemThemeLoader(
+            Path('tests') / 'data',
+            filter=lambda path: not path.name.startswith('_')
+        ),
+        UnlistableThemeLoader()
+    ])
+    themer.current_theme_loader(lambda: 'test_theme')
+    return app
+
+
+def test_warmup(monkeypatch, caplog):
+    """Ensure every template of every theme is compiled ahead of time."""
+    app = make_app()
+    themer = app.extensions['themer']
+
+    with app.app_context():
+        report = themer.warmup(workers=2)
+
+    assert report.compiled == 5
+    assert not report.errors
+    assert len(report.timings) == 5
+    assert report.timings[0][1] >= report.timings[-1][1]
+    assert 'Not warming up theme unlistable' in caplog.text
+
+    def compile(*args, **kwargs):
+        raise AssertionError('Template was compiled.')
+
+    monkeypatch.setattr(app.jinja_env, 'compile', compile)
+
+    with app.app_context():
+        assert render_template('test.html') == 'This is a test.'
+        assert render_template('inheritance.html') == (
+            'This is rendered in other_test_theme.'
+        )
+
+
+def test_warmup_subset():
+    """Ensure just some themes can be warmed up."""
+    app = make_app()
+    themer = app.extensions['themer']
+
+    report = themer.warmup(app, themes=['other_test_theme'])
+    assert [name for name, _ in report.timings] == [
+        f'{MAGIC_PATH_PREFIX}/other_test_theme/inheritance.html'
+    ]
+
+
+def test_warmup_errors(tmp_path, caplog):
+    """Ensure templates that fail to compile are reported."""
+    (tmp_path / 'broken').mkdir()
+    (tmp_path / 'broken' / 'syntax.html').write_text('{% if %}')
+    (tmp_path / 'broken' / 'fine.html').write_text('Fine.')
+
+    app = Flask('testing')
+    themer = Themer(app, loaders=[FileSystemThemeLoader(tmp_path)])
+
+    report = themer.warmup(app)
+    assert report.compiled == 1
+    assert list(report.errors) == [f'{MAGIC_PATH_PREFIX}/broken/syntax.html']
+    assert 'Failed to warm up' in caplog.text
+
+
+def test_warmup_small_cache(caplog):
+    """Ensure we warn when the template cache is too small to hold every
+    template."""
+    app = make_app()
+    app.jinja_env.cache = LRUCache(2)
+
+    app.extensions['themer'].warmup(app)
+    assert 'the template cache only holds 2' in caplog.text
+
+
+def test_warmup_on_init(monkeypatch):
+    """Ensure warming up can be done automatically by init_app."""
+    app = make_app(THEMER_WARMUP=True, THEMER_WARMUP_THEMES=['test_theme'])
+
+    def compile(*args, **kwargs):
+        raise AssertionError('Template was compiled.')
+
+    monkeypatch.setattr(app.jinja_env, 'compile', compile)
+
+    with app.app_context():
+        assert render_template('test.html') == 'This is a test.'
@@ -0,0 +1,291 @@
+import os
+import time
+
+import pytest
+from flask import Flask
+
+import flask_themer
+from flask_themer import (
+    Themer,
+    ThemeError,
+    ThemeLoader,
+    ThemeWatcher,
+    FileSystemThemeLoader,
+    MAGIC_PATH_PREFIX,
+    render_template
+)
+
+
+class EmptyThemeLoader(ThemeLoader):
+    themes = ()
+
+
+@pytest.fixture
+def theme_dir(tmp_path):
+    theme = tmp_path / 'themes' / 'a'
+    (theme / 'static').mkdir(parents=True)
+    (theme / 'test.html').write_text('Version 1')
+    (theme / 'static' / 'site.css').write_text('body {}')
+    (tmp_path / 'templates').mkdir()
+    (tmp_path / 'templates' / 'fallback.html').write_text('Fallback')
+    return tmp_path / 'themes'
+
+
+@pytest.fixture
+def app(theme_dir):
+    app = Flask('testing', template_folder=theme_dir.parent / 'templates')
+    app.config['SERVER_NAME'] = 'testing'
+    app.config['THEMER_STATIC_CACHE_SIZE'] = 1024
+    app.jinja_env.auto_reload = False
+
+    themer = Themer(app, loaders=[
+        EmptyThemeLoader(),
+        FileSystemThemeLoader(theme_dir, index=True)
+    ])
+    themer.current_theme_loader(lambda: 'a')
+
+    return app
+
+
+def touch(path, text):
+    """Write `text` to `path`, making sure its mtime changes."""
+    path.write_text(text)
+    mtime = time.time() + 10
+    os.utime(path, (mtime, mtime))
+
+
+def test_poll(app, theme_dir):
+    """Ensure changes to themes are picked up and only the changed theme's
+    caches are invalidated."""
+    themer = app.extensions['themer']
+    watcher = ThemeWatcher(app)
+
+    assert watcher.poll() == []
+
+    with app.app_context():
+        assert render_template('test.html') == 'Version 1'
+        assert render_template('fallback.html') == 'Fallback'
+        with app.test_client() as client:
+            client.get('http://testing/_theme/a/site.css')
+        assert len(themer.static_cache) == 1
+
+    touch(theme_dir / 'a' / 'test.html', 'Version 2')
+    (theme_dir / 'a' / 'fallback.html').write_text('Themed fallback')
+    assert watcher.poll() == ['a']
+
+    assert len(themer.static_cache) == 0
+    assert 'a' not in themer._resolved
+
+    with app.app_context():
+        assert render_template('test.html') == 'Version 2'
+        assert render_template('fallback.html') == 'Themed fallback'
+
+    # New themes are discovered...
+    (theme_dir / 'b').mkdir()
+    (theme_dir / 'b' / 'test.html').write_text('Theme B')
+    (theme_dir / 'b' / 'broken.html').symlink_to(theme_dir / 'nowhere')
+    a = themer.themes['a']
+    assert watcher.poll() == ['b']
+    assert 'b' in themer.themes
+    # ... without replacing unchanged themes.
+    assert themer.themes['a'] is a
+
+    with app.app_context():
+        themer.current_theme_loader(lambda: 'b')
+        assert render_template('test.html') == 'Theme B'
+
+    # ... and removed themes are forgotten.
+    for path in (theme_dir / 'b').iterdir():
+        path.unlink()
+    (theme_dir / 'b').rmdir()
+    assert watcher.poll() == ['b']
+    assert 'b' not in themer.themes
+
+    with app.app_context():
+        assert render_template('fallback.html') == 'Fallback'
+
+
+def test_invalidate_all(app, theme_dir):
+    """Ensure every theme's compiled templates can be invalidated at once."""
+    themer = app.extensions['themer']
+
+    with app.app_context():
+        assert render_template('test.html') == 'Version 1'
+        touch(theme_dir / 'a' / 'test.html', 'Version 2')
+        assert render_template('test.html') == 'Version 1'
+
+        themer.invalidate()
+        assert render_template('test.html') == 'Version 2'
+
+
+def test_invalidate_race(app):
+    """Ensure templates evicted by someone else while invalidating are
+    ignored."""
+    themer = app.extensions['themer']
+
+    class RacingCache(dict):
+        def __delitem__(self, key):
+            raise KeyError(key)
+
+    app.jinja_env.cache = RacingCache({
+        (None, f'{MAGIC_PATH_PREFIX}/a/test.html'): None,
+        (None, 'fallback.html'): None
+    })
+
+    with app.app_context():
+        themer.invalidate('a')
+
+
+@pytest.mark.parametrize('backend', ['poll', 'watchdog'])
+def test_background(app, theme_dir, monkeypatch, backend):
+    """Ensure changes are picked up by the background thread, and that
+    errors don't stop it."""
+    watcher = ThemeWatcher(app, interval=0.01, backend=backend)
+    errors = []
+    monkeypatch.setattr(
+        app.logger,
+        'exception',
+        lambda *args, **kwargs: errors.append(args)
+    )
+
+    real_poll = watcher.poll
+    calls = []
+
+    def poll():
+        calls.append(True)
+        if len(calls) == 1:
+            raise ValueError('Oops')
+        return real_poll()
+
+    monkeypatch.setattr(watcher, 'poll', poll)
+
+    with app.app_context():
+        assert render_template('test.html') == 'Version 1'
+
+    watcher.start()
+    try:
+        touch(theme_dir / 'a' / 'test.html', 'Version 2')
+
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            with app.app_context():
+                if render_template('test.html') == 'Version 2':
+                    break
+            time.sleep(0.01)
+        else:  # pragma: no cover
+            pytest.fail('Change was never picked up.')
+    finally:
+        watcher.stop()
+
+    assert len(errors) == 1
+    # Stopping twice is harmless.
+    watcher.stop()
+
+
+def test_watchdog_idle(app, monkeypatch):
+    """Ensure the watchdog backend only polls once when started, and then
+    only when something changes."""
+    watcher = ThemeWatcher(app, interval=0.01, backend='watchdog')
+    calls = []
+    monkeypatch.setattr(watcher, 'poll', lambda: calls.append(True))
+
+    watcher.start()
+    try:
+        deadline = time.monotonic() + 5
+        while not calls and time.monotonic() < deadline:
+            time.sleep(0.01)
+        watcher._changed.clear()
+        time.sleep(0.1)
+    finally:
+        watcher.stop()
+
+    assert len(calls) == 1
+
+
+def test_backend(app, monkeypatch):
+    """Ensure the watchdog backend is used when it's installed."""
+    assert ThemeWatcher(app).backend == 'watchdog'
+
+    with pytest.raises(ValueError):
+        ThemeWatcher(app, backend='inotify')
+
+    monkeypatch.setattr(flask_themer, 'Observer', None)
+    assert ThemeWatcher(app).backend == 'poll'
+    with pytest.raises(ThemeError):
+        ThemeWatcher(app, backend='watchdog')
+
+
+def test_watchdog_ignores_reads(app, theme_dir):
+    """Ensure reading files doesn't cause the watchdog backend to poll."""
+    watcher = ThemeWatcher(app, backend='watchdog')
+    handler = flask_themer._WatchdogHandler(watcher._changed)
+
+    class Event:
+        def __init__(self, event_type):
+            self.event_type = event_type
+
+    handler.dispatch(Event('opened'))
+    handler.dispatch(Event('closed_no_write'))
+    assert not watcher._changed.is_set()
+
+    handler.dispatch(Event('modified'))
+    assert watcher._changed.is_set()
+
+
+def test_unchanged_directories_not_listed(app, theme_dir, monkeypatch):
+    """Ensure directories are only listed again when their mtime changes."""
+    watcher = ThemeWatcher(app)
+    listed = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        listed.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', counting_scandir)
+
+    # Changing a file is still picked up, without listing anything.
+    touch(theme_dir / 'a' / 'test.html', 'Version 2')
+    assert watcher.poll() == ['a']
+    assert listed == []
+
+    (theme_dir / 'a' / 'static' / 'new.css').write_text('')
+    mtime = time.time() + 10
+    os.utime(theme_dir / 'a' / 'static', (mtime, mtime))
+    assert watcher.poll() == ['a']
+    assert listed == [str(theme_dir / 'a' / 'static')]
+
+
+def test_lazy(theme_dir):
+    """Ensure only the themes a lazy loader has loaded are checked."""
+    (theme_dir / 'b').mkdir()
+    (theme_dir / 'b' / 'test.html').write_text('Theme B')
+
+    app = Flask('testing')
+    app.jinja_env.auto_reload = False
+    themer = Themer(app, loaders=[
+        FileSystemThemeLoader(theme_dir, lazy=True)
+    ])
+    watcher = ThemeWatcher(app, backend='poll')
+    assert watcher._snapshot == {}
+
+    with app.app_context():
+        themer.current_theme_loader(lambda: 'b')
+        assert render_template('test.html') == 'Theme B'
+
+    # Loading a theme isn't a change.
+    assert watcher.poll() == []
+    assert list(watcher._snapshot) == [(0, 'b')]
+
+    touch(theme_dir / 'b' / 'test.html', 'Changed')
+    touch(theme_dir / 'a' / 'test.html', 'Version 2')
+    assert watcher.poll() == ['b']
+
+    with app.app_context():
+        assert render_template('test.html') == 'Changed'
+
+    # Removing a loaded theme is.
+    (theme_dir / 'b' / 'test.html').unlink()
+    (theme_dir / 'b').rmdir()
+    assert watcher.poll() == ['b']
+    assert watcher.poll() == []